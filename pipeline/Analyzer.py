@@ -1,19 +1,147 @@
-import fitz
+import re
+import numpy as np
+from Document import open_document
+from Geometry import intersection_over_a, areas
 
 class Analyze:
+    NATIVE = "native"
+    SCANNED = "scanned"
+    MIXED = "mixed"
+    EMPTY = "empty"
+
+    # A page with text and at least this much of its area under images is treated as mixed
+    MIXED_IMAGE_COVERAGE = 0.5
+
+    # Strings shown by Tj, ', " and TJ in a content stream, literal (...) or hex <...>
+    TEXT_SHOW_RE = re.compile(rb"(\((?:\\.|[^\\)])*\)|<[0-9A-Fa-f\s]*>)\s*(?:Tj|'|\")|\[((?:\\.|[^\\\]])*)\]\s*TJ", re.S)
+    STRING_RE = re.compile(rb"\((?:\\.|[^\\)])*\)|<[0-9A-Fa-f\s]*>", re.S)
+
     def __init__(self):
         pass
 
-    def has_text_layer(self, input_path):
-        with fitz.open(input_path) as pdf:
+    def has_text_layer(self, document):
+        with open_document(document) as pdf:
             for page in pdf:
                 if page.get_text().strip():
                     return True
             return False
 
-    def has_alligned_text_layer(self, input_path, layout_coordinates):
-        return True
+    # Per page route without extracting any text: native text, scanned, mixed (text over large images) or empty.
+    # pages limits it to some pages (a shard's range), the routes are in the same order.
+    def triage(self, document, pages=None):
+        with open_document(document) as pdf:
+            with pdf.lock:
+                if pages is None:
+                    return [self.triage_page(page) for page in pdf]
+                return [self.triage_page(pdf.page(i)) for i in pages]
+
+    def triage_page(self, page):
+        has_text = self._shows_text(page)
+
+        # Text drawn inside form xobjects is not in the page's own content stream, only then pay for the exact check
+        if not has_text and page.get_fonts() and page.get_xobjects():
+            has_text = bool(page.get_text("words"))
+
+        # Placing the images means interpreting the page, skip it when the resources have no images at all
+        page_area = abs(page.rect)
+        covered = 0.0
+        if page.get_images():
+            for image in page.get_image_info():
+                covered += abs(page.rect & image["bbox"])
+        coverage = min(covered / page_area, 1.0) if page_area else 0.0
+
+        if has_text:
+            return self.MIXED if coverage >= self.MIXED_IMAGE_COVERAGE else self.NATIVE
+        return self.SCANNED if coverage > 0 else self.EMPTY
+
+    # True if the content stream shows any string that is not just whitespace
+    def _shows_text(self, page):
+        if not page.get_fonts():
+            return False
+
+        contents = page.read_contents()
+        if b"BT" not in contents:
+            return False
+
+        for match in self.TEXT_SHOW_RE.finditer(contents):
+            strings = [match.group(1)] if match.group(1) else self.STRING_RE.findall(match.group(2))
+            for string in strings:
+                if string.startswith(b"("):
+                    if string[1:-1].strip():
+                        return True
+                else:
+                    digits = re.sub(rb"\s", b"", string[1:-1])
+                    # <20> and <0020> are a space in simple and two-byte encodings
+                    if digits.lstrip(b"0").upper() not in (b"", b"20"):
+                        return True
+        return False
+
+    # A word counts as aligned when at least this much of it falls inside one layout box,
+    # a page is aligned when at least ALIGNED_WORDS of its words are (pages with fewer than MIN_WORDS always are)
+    ALIGNMENT_IOW = 0.5
+    ALIGNED_WORDS = 0.6
+    MIN_WORDS = 5
+
+    # A box with this much of its area inside another box is nested in it
+    NESTED_CONTAINMENT = 0.9
+
+    # Fraction of the PyMuPDF words that sit inside a detected layout box, None when there is too little to judge.
+    # A text layer that was OCRed from a different scan or shifted on the page scores close to 0.
+    @staticmethod
+    def alignment_score(words, layout_boxes, min_iow=ALIGNMENT_IOW, min_words=MIN_WORDS):
+        if len(words) < min_words or not layout_boxes:
+            return None
+
+        _, iow = intersection_over_a([word[:4] for word in words], [box["pdf_bbox"] for box in layout_boxes])
+        return float((iow.max(axis=1) >= min_iow).mean())
+
+    def page_alignment(self, document, page_data):
+        words = document.words(page_data["page_idx"])
+        return self.alignment_score(words, page_data["boxes"], self.ALIGNMENT_IOW, self.MIN_WORDS)
+
+    def is_aligned(self, document, page_data):
+        score = self.page_alignment(document, page_data)
+        return score is None or score >= self.ALIGNED_WORDS
+
+    # Pages of layout_coordinates whose text layer does not line up with the detected layout,
+    # their text is not trusted and they go to re-OCR like scanned pages
+    def misaligned_pages(self, document, layout_coordinates, skip_pages=()):
+        with open_document(document) as pdf:
+            return {
+                page_data["page_idx"] for page_data in layout_coordinates
+                if page_data["page_idx"] not in skip_pages and not self.is_aligned(pdf, page_data)
+            }
+
+    def has_alligned_text_layer(self, document, layout_coordinates):
+        return not self.misaligned_pages(document, layout_coordinates)
+
+    # Boxes that contain (or duplicate) another box of the same page, the containing one is dropped so only the
+    # small inner boxes are left. Equal boxes keep the first one.
+    @staticmethod
+    def nested_boxes(boxes, containment=NESTED_CONTAINMENT):
+        if len(boxes) < 2:
+            return np.zeros(len(boxes), dtype=bool)
+
+        rects = [box["pdf_bbox"] for box in boxes]
+        # inside[i, j] is True when box i lies (almost) entirely inside box j
+        _, ioa = intersection_over_a(rects, rects)
+        inside = ioa >= containment
+        np.fill_diagonal(inside, False)
+
+        area = areas(rects)
+        index = np.arange(len(boxes))
+        smaller = (area[:, None] < area[None, :]) | ((area[:, None] == area[None, :]) & (index[:, None] < index[None, :]))
+        return (inside & smaller).any(axis=0)
 
     # This function will check the empty text_results_empty and if there are boxes one inside the other it will keep only the small boxes inside
-    def has_overlapping_boxes(self):
-        return True
\ No newline at end of file
+    def has_overlapping_boxes(self, text_results_empty):
+        return any(self.nested_boxes(page_data["boxes"], self.NESTED_CONTAINMENT).any() for page_data in text_results_empty)
+
+    def remove_overlapping_boxes(self, text_results_empty):
+        pages = []
+        for page_data in text_results_empty:
+            drop = self.nested_boxes(page_data["boxes"], self.NESTED_CONTAINMENT)
+            boxes = [box for box, nested in zip(page_data["boxes"], drop) if not nested]
+            if boxes:
+                pages.append({**page_data, "boxes": boxes})
+        return pages
\ No newline at end of file
@@ -0,0 +1,512 @@
+import os
+import re
+import sys
+import glob
+import json
+import hashlib
+import time
+import random
+import argparse
+import platform
+import resource
+import tempfile
+import unicodedata
+import numpy as np
+import multiprocessing as mp
+from Models import registry
+from PostProcess import PostProcess
+from SectionExtractor import TextExtract, SectionCrop, DPIPolicy
+
+# Reference implementation, kept to check that the fast paths give the same answer
+def legacy_assign_words(all_words, layout_boxes):
+    box_contents = {i: [] for i in range(len(layout_boxes))}
+
+    for word in all_words:
+        wx0, wt, wx1, wb, text = word[0], word[1], word[2], word[3], word[4]
+        word_area = (wx1 - wx0) * (wb - wt) + 1e-9
+
+        candidates = []
+        for idx, box in enumerate(layout_boxes):
+            bx0, bt, bx1, bb = box["pdf_bbox"]
+
+            ix0 = max(wx0, bx0)
+            it  = max(wt, bt)
+            ix1 = min(wx1, bx1)
+            ib  = min(wb, bb)
+
+            if ix1 > ix0 and ib > it:
+                inter_area = (ix1 - ix0) * (ib - it)
+                candidates.append({
+                    "idx": idx,
+                    "iow": inter_area / word_area,
+                    "area": (bx1 - bx0) * (bb - bt)
+                })
+
+        if candidates:
+            best_box = sorted(candidates, key=lambda x: (-x["iow"], x["area"]))[0]
+            box_contents[best_box["idx"]].append(text)
+
+    return box_contents
+
+# Reference chained str.replace/re.sub normalizer, same maps as PostProcess
+class LegacyPostProcess(PostProcess):
+    def process(self, text):
+        text = unicodedata.normalize('NFKC', text)
+        text = re.sub(r'[\x00-\x08\x0b\x0c\x0e-\x1f]', '', text)
+        text = re.sub(r'[\u00AD\u200B\u200C\u200D\uFEFF]', '', text)
+        for mapping in (self.LIGATURES, self.QUOTES, self.DASHES, self.BULLETS):
+            for old, new in mapping.items():
+                text = text.replace(old, new)
+        text = re.sub(r'[\u00A0\u2000-\u200A\u202F\u205F\u3000]', ' ', text)
+        text = re.sub(r' +', ' ', text)
+        text = re.sub(r'\r\n?', '\n', text)
+        text = re.sub(r'\n{3,}', '\n\n', text).strip()
+        text = re.sub(r'(\w+)-\n(\w+)', r'\1\2', text)
+        text = re.sub(r'(\w+)-\s+([a-z])', r'\1\2', text)
+        text = re.sub(r'([.!?])(\w)', self._add_space_after_punct, text)
+        text = re.sub(r'\s+([.!?,;:])', r'\1', text)
+        text = re.sub(r'([,;])(\w)', r'\1 \2', text)
+        return text
+
+# Synthetic A4 page: a grid of layout boxes with words laid out in lines over the whole page,
+# plus a few nested/duplicate boxes so the tie-breaking is exercised
+def synthetic_page(n_words, n_boxes, seed=0):
+    rng = random.Random(seed)
+    page_w, page_h = 595.0, 842.0
+
+    layout_boxes = []
+    for i in range(n_boxes):
+        x0 = rng.uniform(0, page_w * 0.8)
+        y0 = rng.uniform(0, page_h * 0.9)
+        x1 = min(page_w, x0 + rng.uniform(20, page_w * 0.6))
+        y1 = min(page_h, y0 + rng.uniform(10, page_h * 0.2))
+        layout_boxes.append({"order": i, "pdf_bbox": [x0, y0, x1, y1]})
+    layout_boxes.append({"order": n_boxes, "pdf_bbox": list(layout_boxes[0]["pdf_bbox"])})
+
+    words = []
+    x, y = 0.0, 0.0
+    for i in range(n_words):
+        w = rng.uniform(8, 60)
+        if x + w > page_w:
+            x, y = 0.0, (y + 12.0) % page_h
+        words.append((x, y, x + w, y + 10.0, f"w{i}", 0, 0, i))
+        x += w + 3.0
+
+    return words, layout_boxes
+
+def bench(fn, *args, repeat=5):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn(*args)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+def bench_map_words_to_boxes():
+    densities = [(50, 5), (500, 20), (2000, 40), (5000, 80)]
+
+    print(f"{'words':>6} {'boxes':>6} {'legacy ms':>10} {'numpy ms':>10} {'speedup':>8}")
+    for n_words, n_boxes in densities:
+        words, boxes = synthetic_page(n_words, n_boxes)
+
+        assert TextExtract.assign_words(words, boxes) == legacy_assign_words(words, boxes)
+
+        legacy = bench(legacy_assign_words, words, boxes)
+        fast = bench(TextExtract.assign_words, words, boxes)
+        print(f"{n_words:>6} {n_boxes:>6} {legacy * 1e3:>10.2f} {fast * 1e3:>10.2f} {legacy / fast:>7.1f}x")
+
+# Raw (not yet normalized) text of every text box, rebuilt from the recorded layout
+def raw_region_texts(pdf_path, text_coordinates_path):
+    from Document import DocumentSession
+
+    with open(text_coordinates_path, encoding="utf-8") as f:
+        text_coordinates = json.load(f)
+
+    texts = []
+    with DocumentSession(pdf_path) as document:
+        for page_data in text_coordinates:
+            box_contents = TextExtract.assign_words(document.words(page_data["page_idx"]), page_data["boxes"])
+            texts.extend(" ".join(words) for words in box_contents.values() if words)
+    return texts
+
+def bench_post_process():
+    # Golden check: extraction with the compiled normalizer must reproduce the stored results byte for byte
+    with open("output/test2_text_coordinates.json", encoding="utf-8") as f:
+        text_coordinates = json.load(f)
+    with open("output/test2_text_results.json", encoding="utf-8") as f:
+        golden = json.load(f)
+
+    text_results, _ = TextExtract().extract(text_coordinates, "pdfs/test2.pdf")
+    assert json.dumps(text_results, ensure_ascii=False) == json.dumps(golden, ensure_ascii=False)
+
+    # Real text plus every character the maps know about, so the slow paths are exercised too
+    post_processor, legacy = PostProcess(), LegacyPostProcess()
+    special = "".join([*legacy.LIGATURES, *legacy.QUOTES, *legacy.DASHES, *legacy.BULLETS, "\u00AD\u3000\r\n\n\n exam-\nple"])
+    texts = raw_region_texts("pdfs/test2.pdf", "output/test2_text_coordinates.json") + [special]
+    for text in texts:
+        assert post_processor.process(text) == legacy.process(text)
+
+    megabytes = sum(len(text.encode("utf-8")) for text in texts) / 1e6
+    legacy_time = bench(lambda: [legacy.process(text) for text in texts])
+    fast_time = bench(lambda: [post_processor.process(text) for text in texts])
+
+    print(f"{'':>10} {'MB/s':>8}")
+    print(f"{'legacy':>10} {megabytes / legacy_time:>8.2f}")
+    print(f"{'compiled':>10} {megabytes / fast_time:>8.2f}  ({legacy_time / fast_time:.1f}x)")
+
+SAMPLE_PDFS = ["pdfs/test2.pdf", "pdfs/test_small.pdf", "pdfs/table_test.pdf", "pdfs/sample-tables.pdf"]
+
+DPI_POLICIES = {
+    "fixed-250": DPIPolicy(),
+    "per-label": DPIPolicy(label_dpi={"table": 200, "inline_formula": 300, "text": 150}),
+    "target-768": DPIPolicy(target_size=768),
+    "target-1024-cap-2MP": DPIPolicy(target_size=1024, max_pixels=2_000_000),
+}
+
+# Every page gets a full-page table, a half-page text block and a one-line inline formula
+def synthetic_crop_coordinates(pdf_path):
+    from Document import DocumentSession
+
+    coordinates = []
+    with DocumentSession(pdf_path) as document:
+        for page_idx in range(len(document)):
+            rect = document.rect(page_idx)
+            w, h = rect.width, rect.height
+            coordinates.append({
+                "input_path": pdf_path,
+                "page_idx": page_idx,
+                "boxes": [
+                    {"order": 0, "label": "table", "pdf_bbox": [36, 36, w - 36, h - 36]},
+                    {"order": 1, "label": "text", "pdf_bbox": [36, 36, w - 36, h / 2]},
+                    {"order": 2, "label": "inline_formula", "pdf_bbox": [72, h / 2, 272, h / 2 + 14]},
+                ]
+            })
+    return coordinates
+
+# Runs in a fresh process so ru_maxrss is the peak of this policy alone
+def _render_with_policy(policy_name):
+    policy = DPI_POLICIES[policy_name]
+    start_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    start = time.perf_counter()
+    pixels = 0
+    for pdf_path in SAMPLE_PDFS:
+        crops = SectionCrop.crop(synthetic_crop_coordinates(pdf_path), policy=policy)
+        pixels += sum(c["image"].width * c["image"].height for c in crops)
+    seconds = time.perf_counter() - start
+
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return seconds, pixels, start_rss / 1024, peak_rss / 1024
+
+def bench_dpi_policies():
+    ctx = mp.get_context("spawn")
+
+    print(f"{'policy':>20} {'render s':>9} {'Mpixels':>8} {'peak RSS MB':>12} {'growth MB':>10}")
+    for name in DPI_POLICIES:
+        with ctx.Pool(1) as pool:
+            seconds, pixels, start_rss, peak_rss = pool.apply(_render_with_policy, (name,))
+        print(f"{name:>20} {seconds:>9.2f} {pixels / 1e6:>8.1f} {peak_rss:>12.0f} {peak_rss - start_rss:>10.0f}")
+
+# What a recognition model gets handed: PIL crops converted to arrays against array views of the pixmaps
+def bench_crop_outputs():
+    coordinates = synthetic_crop_coordinates("pdfs/sample-tables.pdf")
+    pil_time = bench(lambda: [np.asarray(c["image"]) for c in SectionCrop.crop(coordinates)], repeat=3)
+    array_time = bench(lambda: [c["array"] for c in SectionCrop.crop(coordinates, output="array")], repeat=3)
+    batch_time = bench(lambda: SectionCrop.crop_batch(coordinates), repeat=3)
+
+    print(f"{'output':>8} {'seconds':>8}")
+    print(f"{'pil':>8} {pil_time:>8.2f}")
+    print(f"{'array':>8} {array_time:>8.2f}")
+    print(f"{'batch':>8} {batch_time:>8.2f}")
+
+# A page of full-width one-line regions, the most common empty region, has to fit on one VLM canvas: no crop may come
+# out wider than the canvas because of the DPI policy's rounding
+def bench_vlm_packing(pdf_path="pdfs/test2.pdf", lines=12):
+    from Document import DocumentSession
+    from SectionExtractor import VLMExtract
+
+    extractor = VLMExtract()
+    with DocumentSession(pdf_path) as document:
+        rect = document.rect(0)
+        boxes = [
+            {"order": i, "label": "text", "pdf_bbox": [36, 72 + i * 20, rect.width - 36, 72 + i * 20 + 14]}
+            for i in range(lines)
+        ]
+        coordinates = [{"input_path": pdf_path, "page_idx": 0, "boxes": boxes}]
+        cropped = SectionCrop.crop(coordinates, document, policy=extractor.dpi_policy, output="array")
+
+    widest = max(c["array"].shape[1] for c in cropped)
+    pack_time = bench(lambda: extractor.pack(cropped), repeat=3)
+    canvases = extractor.pack(cropped)
+    assert widest <= extractor.canvas_size, widest
+    assert len(canvases) == 1, [len(canvas["slots"]) for canvas in canvases]
+
+    print(f"{'regions':>8} {'widest px':>10} {'canvases':>9} {'seconds':>8}")
+    print(f"{len(cropped):>8} {widest:>10} {len(canvases):>9} {pack_time:>8.4f}")
+
+# Every bundled PDF, the CPU-side suite runs on all of them
+SUITE_PDFS = sorted(glob.glob("pdfs/*.pdf"))
+
+# Only the result shape is read, a broadcast view costs no memory
+class RecordedResult(dict):
+    def __init__(self, page):
+        width, height = page["image_size"]
+        super().__init__(input_img=np.broadcast_to(np.uint8(0), (height, width, 3)))
+        self.page = page
+
+    @property
+    def json(self):
+        return {"res": {"boxes": [
+            {"coordinate": box["box"], "label": box["label"], "score": box["score"], "cls_id": box["cls_id"]}
+            for box in self.page["boxes"]
+        ]}}
+
+    def save_to_img(self, save_path):
+        pass
+
+# Stand-in for the layout model, returns the same result objects paddle does from a recorded layout per PDF.
+# The pipeline hands it rendered pages, they are told apart by a hash of the page image rendered the same way.
+class RecordedLayout:
+    def __init__(self, layouts, dpi=144):
+        from Document import DocumentSession
+
+        self.pages = {}
+        for path, pages in layouts.items():
+            with DocumentSession(path) as document:
+                for page in pages:
+                    image = np.ascontiguousarray(document.render(page["page_idx"], dpi)[..., ::-1])
+                    self.pages[self.image_key(image)] = page
+
+    @staticmethod
+    def image_key(image):
+        return hashlib.sha1(image.tobytes()).hexdigest(), image.shape
+
+    def predict_iter(self, input, **kwargs):
+        for image in input:
+            page = self.pages.get(self.image_key(image))
+            if page is None:
+                raise ValueError("No recorded layout for this page image, was it rendered at another DPI?")
+            yield RecordedResult(page)
+
+    def predict(self, input, **kwargs):
+        return list(self.predict_iter(input, **kwargs))
+
+# Stand-in for the formula model, every crop gets the same formula
+class RecordedFormula:
+    def predict(self, input, batch_size=1):
+        return [{"rec_formula": "x"} for _ in input]
+
+# output/<name>_layout_coordinates.json when the model was run on it once, otherwise a layout built from the PDF itself:
+# text blocks, images and ruled tables at the 144 DPI paddle renders at
+def recorded_layout(pdf_path, dpi=144):
+    import fitz
+    pdf_name = os.path.splitext(os.path.basename(pdf_path))[0]
+    recorded_path = os.path.join("output", f"{pdf_name}_layout_coordinates.json")
+    if os.path.exists(recorded_path):
+        with open(recorded_path, encoding="utf-8") as f:
+            return json.load(f)
+
+    zoom = dpi / 72
+    pages = []
+    with fitz.open(pdf_path) as doc:
+        for page in doc:
+            regions = [("table", table.bbox) for table in page.find_tables().tables]
+            for block in page.get_text("blocks"):
+                label = "text" if block[6] == 0 else "image"
+                if not any(fitz.Rect(block[:4]) in fitz.Rect(bbox) for _, bbox in regions):
+                    regions.append((label, block[:4]))
+
+            pages.append({
+                "page_idx": page.number,
+                "image_size": [int(page.rect.width * zoom), int(page.rect.height * zoom)],
+                "boxes": [
+                    {"box": [round(v * zoom) for v in bbox], "label": label, "score": 1.0, "cls_id": 0}
+                    for label, bbox in regions
+                ]
+            })
+    return pages
+
+# Serves the recorded layouts and a fixed formula through the model registry, nothing neural is loaded
+def install_recorded_models(pdf_paths):
+    from LayoutDetector import LayoutDetect
+    from SectionExtractor import MathExtract
+
+    registry.put("layout", LayoutDetect().model_name, RecordedLayout({path: recorded_layout(path) for path in pdf_paths}))
+    registry.put("formula", MathExtract().model_name, RecordedFormula())
+
+def best_of(fn, repeat=3):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+# Each CPU-side stage on its own over every PDF, as {name: (value, unit)}, higher is better everywhere
+def bench_stages(pdf_paths):
+    from Analyzer import Analyze
+    from Document import DocumentSession
+    from LayoutDetector import LayoutDetect
+
+    analyzer, detector, text_extractor = Analyze(), LayoutDetect(), TextExtract()
+    results = {}
+    pages = boxes = 0
+    times = {"analyze": 0.0, "layout.filter": 0.0, "text": 0.0, "crop": 0.0}
+    text_bytes, crop_pixels = 0, 0
+    texts = []
+
+    for pdf_path in pdf_paths:
+        with DocumentSession(pdf_path) as document:
+            layout_coordinates = detector.detect(document)
+            pages += len(document)
+            boxes += sum(len(page_data["boxes"]) for page_data in layout_coordinates)
+
+            times["analyze"] += best_of(lambda: analyzer.triage(document))
+            times["layout.filter"] += best_of(lambda: detector.filter(layout_coordinates))
+            text_coordinates, table_coordinates, _ = detector.filter(layout_coordinates)
+
+            times["text"] += best_of(lambda: text_extractor.extract(text_coordinates, document))
+            for page_data in text_coordinates:
+                box_contents = TextExtract.assign_words(document.words(page_data["page_idx"]), page_data["boxes"])
+                texts.extend(" ".join(words) for words in box_contents.values() if words)
+
+            crop_coordinates = synthetic_crop_coordinates(pdf_path)
+            times["crop"] += best_of(lambda: SectionCrop.crop(crop_coordinates, document, output="array"))
+            crop_pixels += sum(DPIPolicy().pixels(box) for page_data in crop_coordinates for box in page_data["boxes"])
+
+    post_processor, legacy = PostProcess(), LegacyPostProcess()
+    text_bytes = sum(len(text.encode("utf-8")) for text in texts)
+    times["post_process"] = best_of(lambda: [post_processor.process(text) for text in texts])
+    times["post_process.legacy"] = best_of(lambda: [legacy.process(text) for text in texts])
+
+    words, layout_boxes = synthetic_page(2000, 40)
+    times["assign_words"] = best_of(lambda: TextExtract.assign_words(words, layout_boxes), repeat=5)
+    times["assign_words.legacy"] = best_of(lambda: legacy_assign_words(words, layout_boxes), repeat=5)
+
+    results["analyze"] = (pages / times["analyze"], "pages/s")
+    results["layout.filter"] = (boxes / times["layout.filter"], "boxes/s")
+    results["text"] = (pages / times["text"], "pages/s")
+    results["assign_words"] = (2000 / times["assign_words"], "words/s")
+    results["post_process"] = (text_bytes / 1e6 / times["post_process"], "MB/s")
+    # Speedups over the reference implementations on the same inputs, these hold on any machine
+    results["assign_words.speedup"] = (times["assign_words.legacy"] / times["assign_words"], RELATIVE_UNIT)
+    results["post_process.speedup"] = (times["post_process.legacy"] / times["post_process"], RELATIVE_UNIT)
+    results["crop"] = (crop_pixels / 1e6 / times["crop"], "Mpixels/s")
+    return results
+
+# The whole pipeline (math on, VLM off) per PDF, pages/s overall and per stage from the profiler
+def bench_end_to_end(pdf_paths, repeat=3):
+    from Pipeline import Pipeline
+
+    stage_seconds = {}
+    stage_pages = {}
+    total = float("inf")
+    pages = 0
+    for _ in range(repeat):
+        with tempfile.TemporaryDirectory() as output_path:
+            pipeline = Pipeline(output_path=output_path, math=True)
+            run_seconds = 0.0
+            run_pages = 0
+            for pdf_path in pdf_paths:
+                result = pipeline.run(pdf_path)
+                run_seconds += result["seconds"]
+                run_pages += result["pages"]
+                for name, entry in result["profile"].items():
+                    if "." not in name and entry.get("pages"):
+                        stage_seconds.setdefault(name, []).append(entry["wall"])
+                        stage_pages.setdefault(name, []).append(entry["pages"])
+            if run_seconds < total:
+                total, pages = run_seconds, run_pages
+
+    # Each stage's total over the PDFs, best of the repeats
+    results = {"e2e": (pages / total, "pages/s")}
+    for name, seconds in stage_seconds.items():
+        per_run = len(seconds) // repeat
+        runs = [sum(seconds[i:i + per_run]) for i in range(0, len(seconds), per_run)]
+        results[f"e2e.{name}"] = (sum(stage_pages[name][:per_run]) / min(runs), "pages/s")
+    return results
+
+BASELINE_PATH = "benchmark_baseline.json"
+# Unit of the results that are ratios to a reference implementation instead of throughputs
+RELATIVE_UNIT = "x legacy"
+
+# CPU model and count, throughputs are only compared against a baseline recorded on the same
+def machine_id():
+    cpu = platform.processor()
+    try:
+        with open("/proc/cpuinfo", encoding="utf-8") as f:
+            cpu = next((line.split(":", 1)[1].strip() for line in f if line.startswith("model name")), cpu)
+    except OSError:
+        pass
+    return f"{platform.machine()} {cpu} x{os.cpu_count()}"
+
+# Anything more than tolerance below the stored baseline is a regression. Throughputs only mean something on the
+# machine the baseline was recorded on, elsewhere only the speedups over the reference implementations are compared.
+def compare_baseline(results, baseline_path=BASELINE_PATH, tolerance=0.25):
+    baseline, machine = {}, None
+    if os.path.exists(baseline_path):
+        with open(baseline_path, encoding="utf-8") as f:
+            stored = json.load(f)
+        baseline, machine = stored["results"], stored.get("machine")
+
+    same_machine = machine == machine_id()
+    if baseline and not same_machine:
+        print(f"Baseline recorded on {machine}, this is {machine_id()}: throughputs are not compared")
+
+    regressions = []
+    print(f"{'benchmark':>20} {'value':>12} {'unit':>10} {'baseline':>12} {'change':>8}")
+    for name, (value, unit) in results.items():
+        reference = baseline.get(name, {}).get("value")
+        if not same_machine and unit != RELATIVE_UNIT:
+            reference = None
+        change = ""
+        if reference:
+            ratio = value / reference
+            change = f"{(ratio - 1) * 100:+.0f}%"
+            if ratio < 1 - tolerance:
+                regressions.append(name)
+                change += " !"
+        reference_text = f"{reference:.2f}" if reference else "-"
+        print(f"{name:>20} {value:>12.2f} {unit:>10} {reference_text:>12} {change:>8}")
+    return regressions
+
+def save_baseline(results, baseline_path=BASELINE_PATH):
+    with open(baseline_path, "w", encoding="utf-8") as f:
+        json.dump({
+            "pdfs": SUITE_PDFS,
+            "python": platform.python_version(),
+            "machine": machine_id(),
+            "results": {name: {"value": value, "unit": unit} for name, (value, unit) in results.items()}
+        }, f, ensure_ascii=False, indent=4)
+
+# CPU only, deterministic inputs: recorded layouts instead of the layout model and a fixed formula
+def run_suite(save=False, tolerance=0.25):
+    install_recorded_models(SUITE_PDFS)
+
+    results = bench_stages(SUITE_PDFS)
+    results.update(bench_end_to_end(SUITE_PDFS))
+
+    regressions = compare_baseline(results, tolerance=tolerance)
+    if save:
+        save_baseline(results)
+        print(f"Baseline written to {BASELINE_PATH}")
+    elif regressions:
+        print(f"Regressions over {tolerance:.0%}: {', '.join(regressions)}")
+    return regressions
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmarks of the CPU-side pipeline code.")
+    parser.add_argument("--suite-only", action="store_true", help="Skip the micro-benchmarks, run only the stage suite")
+    parser.add_argument("--save-baseline", action="store_true", help=f"Store this run as the new {BASELINE_PATH}")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="Slowdown against the baseline that counts as a regression")
+    args = parser.parse_args()
+
+    if not args.suite_only:
+        bench_map_words_to_boxes()
+        bench_post_process()
+        bench_dpi_policies()
+        bench_crop_outputs()
+        bench_vlm_packing()
+
+    if run_suite(args.save_baseline, args.tolerance):
+        sys.exit(1)
@@ -0,0 +1,71 @@
+import zlib
+import queue
+import threading
+
+# Which debug images (layout page images, table and VLM crops) get written, and a background thread that writes them
+# so PNG encoding and disk latency stay off the pages' critical path. The JSON results are not debug output, resume,
+# the shard merge and the pages output read them back, they are always written.
+# off writes none, full writes every one, sampled writes those of one in every_documents documents (picked by name,
+# so the same ones on every run and in every worker) and in those every every_pages-th page, or with empty_pages
+# only the pages that ended up with empty text regions.
+class DebugOutput:
+    MODES = ("off", "sampled", "full")
+
+    def __init__(self, mode="full", every_pages=10, every_documents=1, empty_pages=False, queue_size=32):
+        if mode not in self.MODES:
+            raise ValueError(f"Unknown debug output mode {mode!r}, expected one of {', '.join(self.MODES)}")
+        self.mode = mode
+        self.every_pages = max(1, every_pages)
+        self.every_documents = max(1, every_documents)
+        self.empty_pages = empty_pages
+        # Bounded so a slow disk holds the pipeline back instead of piling up page images in memory
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.thread = None
+        self.errors = []
+        self.document = mode == "full"
+        self.empty = set()
+
+    # Called at the start of every document (and every shard of one)
+    def start(self, pdf_name):
+        if self.mode == "sampled":
+            self.document = zlib.crc32(pdf_name.encode("utf-8")) % self.every_documents == 0
+        self.empty = set()
+
+    # Pages with empty text regions, known once the text stage is done
+    def mark_empty(self, empty_regions):
+        self.empty.update(page["page_idx"] for page in empty_regions if page["boxes"])
+
+    def page(self, page_idx):
+        if self.mode == "full":
+            return True
+        if not self.document:
+            return False
+        if self.empty_pages:
+            return page_idx in self.empty
+        return page_idx % self.every_pages == 0
+
+    # Queues fn(*args, **kwargs) for the writer thread, blocks while the queue is full
+    def write(self, fn, *args, **kwargs):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._run, daemon=True)
+            self.thread.start()
+        self.queue.put((fn, args, kwargs))
+
+    def _run(self):
+        while True:
+            fn, args, kwargs = self.queue.get()
+            try:
+                fn(*args, **kwargs)
+            except Exception as e:
+                self.errors.append(e)
+            finally:
+                self.queue.task_done()
+
+    # Waits until everything queued so far is on disk, the first failed write is raised here
+    def flush(self):
+        if self.thread is not None:
+            self.queue.join()
+        if self.errors:
+            error = self.errors[0]
+            self.errors = []
+            raise error
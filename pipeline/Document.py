@@ -0,0 +1,146 @@
+import fitz
+import hashlib
+import threading
+import numpy as np
+from contextlib import contextmanager
+
+# One open PDF shared by every stage, pages, words and page rects are parsed once and reused.
+# PyMuPDF is not thread safe so every call into it goes through the lock.
+class DocumentSession:
+    def __init__(self, input_path):
+        self.input_path = input_path
+        self.doc = fitz.open(input_path)
+        self.lock = threading.RLock()
+        self.pages = {}
+        self.page_words = {}
+        self.page_rects = {}
+        self.page_tables = {}
+        self.page_drawings = {}
+        # PageRasters the layout stage leaves its rendered pages in for the crops, None renders every crop
+        self.rasters = None
+
+    def __len__(self):
+        return len(self.doc)
+
+    def __iter__(self):
+        for page_idx in range(len(self.doc)):
+            yield self.page(page_idx)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def page(self, page_idx):
+        with self.lock:
+            if page_idx not in self.pages:
+                self.pages[page_idx] = self.doc[page_idx]
+            return self.pages[page_idx]
+
+    def words(self, page_idx):
+        with self.lock:
+            if page_idx not in self.page_words:
+                self.page_words[page_idx] = self.page(page_idx).get_text("words")
+            return self.page_words[page_idx]
+
+    def rect(self, page_idx):
+        with self.lock:
+            if page_idx not in self.page_rects:
+                self.page_rects[page_idx] = self.page(page_idx).rect
+            return self.page_rects[page_idx]
+
+    # Bounding boxes (x0, y0, x1, y1) of the page's vector drawings, a ruling line is one with no width or height
+    def drawings(self, page_idx):
+        with self.lock:
+            if page_idx not in self.page_drawings:
+                self.page_drawings[page_idx] = [tuple(d["rect"]) for d in self.page(page_idx).get_cdrawings()]
+            return self.page_drawings[page_idx]
+
+    # Whole page as an RGB array (height, width, 3)
+    def render(self, page_idx, dpi):
+        with self.lock:
+            zoom = dpi / 72
+            pix = self.page(page_idx).get_pixmap(matrix=fitz.Matrix(zoom, zoom), alpha=False)
+            return np.frombuffer(pix.samples, dtype=np.uint8).reshape(pix.height, pix.width, pix.n)
+
+    # One region of a page, bbox in PDF points
+    def render_clip(self, page_idx, bbox, dpi):
+        with self.lock:
+            zoom = dpi / 72
+            return self.page(page_idx).get_pixmap(matrix=fitz.Matrix(zoom, zoom), clip=fitz.Rect(*bbox))
+
+    # PyMuPDF's table finder on one region (bbox in PDF points) or the whole page (bbox None, found once per strategy),
+    # strategy "lines" follows ruling lines, "text" word gaps. Only the grid comes back, as plain data: the bbox and
+    # one cell bbox per row and column, None where a merged cell continues.
+    def find_tables(self, page_idx, bbox=None, strategy="lines"):
+        with self.lock:
+            if bbox is None and (page_idx, strategy) in self.page_tables:
+                return self.page_tables[(page_idx, strategy)]
+
+            clip = fitz.Rect(*bbox) if bbox is not None else None
+            tables = self.page(page_idx).find_tables(clip=clip, strategy=strategy).tables
+            tables = [{
+                "bbox": list(table.bbox),
+                "cells": [[list(cell) if cell is not None else None for cell in row.cells] for row in table.rows]
+            } for table in tables]
+
+            if bbox is None:
+                self.page_tables[(page_idx, strategy)] = tables
+            return tables
+
+    # Hash of everything that changes how the page looks: geometry, content stream, fonts, images and forms
+    def content_hash(self, page_idx):
+        with self.lock:
+            page = self.page(page_idx)
+            h = hashlib.sha256()
+            h.update(repr((tuple(page.rect), page.rotation)).encode("utf-8"))
+            h.update(page.read_contents())
+            h.update(repr([font[3:5] for font in page.get_fonts()]).encode("utf-8"))
+            for xref in sorted({img[0] for img in page.get_images()} | {xobj[0] for xobj in page.get_xobjects()}):
+                h.update(self.doc.xref_stream_raw(xref) or b"")
+            return h.hexdigest()
+
+    def close(self):
+        self.pages.clear()
+        self.page_words.clear()
+        self.page_rects.clear()
+        self.page_tables.clear()
+        self.page_drawings.clear()
+        if self.rasters is not None:
+            self.rasters.close()
+        self.doc.close()
+
+# Lets a stage take either a path or an already open session, only sessions opened here get closed here
+@contextmanager
+def open_document(source):
+    if isinstance(source, DocumentSession):
+        yield source
+        return
+
+    document = DocumentSession(source)
+    try:
+        yield document
+    finally:
+        document.close()
+
+# Process pool workers open their own copy of the PDF, PyMuPDF objects cannot be shared between processes.
+# The pool outlives a document, a worker keeps the last PDF it rendered from open until it is asked for another one.
+_worker_document = None
+
+def worker_document(input_path):
+    global _worker_document
+    if _worker_document is None or _worker_document.input_path != input_path:
+        if _worker_document is not None:
+            _worker_document.close()
+        _worker_document = DocumentSession(input_path)
+    return _worker_document
+
+# jobs are (page_idx, order, label, pdf_bbox, dpi), raw RGB bytes go back since pixmaps cannot be pickled
+def render_clips(input_path, jobs):
+    document = worker_document(input_path)
+    rendered = []
+    for page_idx, order, label, bbox, dpi in jobs:
+        pix = document.render_clip(page_idx, bbox, dpi)
+        rendered.append((page_idx, order, label, pix.width, pix.height, pix.samples))
+    return rendered
@@ -0,0 +1,60 @@
+import numpy as np
+
+# Intersection of every rect in a with every rect in b, divided by the area of the rect in a.
+# Rects are [x0, y0, x1, y1], a is (n, 4) and b is (m, 4), both results are (n, m):
+# hit is True where the two rects overlap, ioa is the covered fraction of a (-inf where they do not overlap).
+def intersection_over_a(a, b):
+    a = np.asarray(a, dtype=np.float64).reshape(-1, 4)
+    b = np.asarray(b, dtype=np.float64).reshape(-1, 4)
+
+    ax0, ay0, ax1, ay1 = (a[:, i:i + 1] for i in range(4))
+    bx0, by0, bx1, by1 = (b[:, i] for i in range(4))
+
+    a_area = (ax1 - ax0) * (ay1 - ay0) + 1e-9
+
+    ix0 = np.maximum(ax0, bx0)
+    iy0 = np.maximum(ay0, by0)
+    ix1 = np.minimum(ax1, bx1)
+    iy1 = np.minimum(ay1, by1)
+
+    hit = (ix1 > ix0) & (iy1 > iy0)
+    ioa = np.where(hit, (ix1 - ix0) * (iy1 - iy0) / a_area, -np.inf)
+    return hit, ioa
+
+def areas(rects):
+    rects = np.asarray(rects, dtype=np.float64).reshape(-1, 4)
+    return (rects[:, 2] - rects[:, 0]) * (rects[:, 3] - rects[:, 1])
+
+# Shelf packing of (width, height) items into canvases of at most canvas_width x canvas_height, tallest items first,
+# gap pixels between items. Returns (placements, width, height) per canvas, placements are (item index, x, y) and
+# the canvas is only as large as what was placed on it. An item larger than the canvas gets a canvas of its own.
+def pack_shelves(sizes, canvas_width, canvas_height, gap=0, max_items=None):
+    canvases = []
+    placements = []
+    x = y = shelf_height = used_width = used_height = 0
+
+    def close():
+        if placements:
+            canvases.append((list(placements), used_width, used_height))
+            placements.clear()
+
+    for i in sorted(range(len(sizes)), key=lambda i: -sizes[i][1]):
+        w, h = sizes[i]
+        if w > canvas_width or h > canvas_height:
+            canvases.append(([(i, 0, 0)], w, h))
+            continue
+
+        if placements and x + w > canvas_width:
+            x, y, shelf_height = 0, y + shelf_height + gap, 0
+        if placements and (y + h > canvas_height or len(placements) == max_items):
+            close()
+            x = y = shelf_height = used_width = used_height = 0
+
+        placements.append((i, x, y))
+        used_width = max(used_width, x + w)
+        used_height = max(used_height, y + h)
+        shelf_height = max(shelf_height, h)
+        x += w + gap
+
+    close()
+    return canvases
@@ -0,0 +1,105 @@
+import os
+import json
+import hashlib
+from collections import OrderedDict
+
+# On-disk cache of per-page layout detections, size bounded with least recently used eviction.
+# Entries are keyed by page content and every setting that changes what the model returns.
+# Workers can share the directory, each one rescans it after writing rescan_bytes so the entries of the others count
+# against max_bytes too, together they go over it by at most rescan_bytes each.
+class LayoutCache:
+    def __init__(self, cache_dir=".layout_cache", max_bytes=1024 * 1024 * 1024, rescan_bytes=None):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.rescan_bytes = rescan_bytes if rescan_bytes is not None else max(1, max_bytes // 16)
+        self.hits = 0
+        self.misses = 0
+
+        os.makedirs(cache_dir, exist_ok=True)
+        self.scan()
+
+    # key -> file size, oldest first, rebuilt from file modification times
+    def scan(self):
+        entries = []
+        for root, _, files in os.walk(self.cache_dir):
+            for name in files:
+                if name.endswith(".json"):
+                    try:
+                        stat = os.stat(os.path.join(root, name))
+                    except FileNotFoundError:
+                        continue
+                    entries.append((stat.st_mtime, name[:-5], stat.st_size))
+
+        self.entries = OrderedDict((key, size) for _, key, size in sorted(entries))
+        self.total_bytes = sum(self.entries.values())
+        self.unscanned_bytes = 0
+
+    @staticmethod
+    def key(page_hash, model, threshold, layout_nms, dpi):
+        settings = json.dumps([page_hash, model, threshold, layout_nms, dpi])
+        return hashlib.sha256(settings.encode("utf-8")).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key[:2], f"{key}.json")
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            with open(path, encoding="utf-8") as f:
+                value = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            # Another worker sharing the directory may have evicted it
+            self.misses += 1
+            if key in self.entries:
+                self.total_bytes -= self.entries.pop(key)
+            return None
+
+        self.hits += 1
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            # Evicted by another worker since it was read, the value is still good
+            pass
+        if key in self.entries:
+            self.entries.move_to_end(key)
+        return value
+
+    def put(self, key, value):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        # Write then rename so a crash or a parallel reader never sees half an entry
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(value, f, ensure_ascii=False)
+        size = os.path.getsize(tmp_path)
+        os.replace(tmp_path, path)
+
+        if key in self.entries:
+            self.total_bytes -= self.entries.pop(key)
+        self.entries[key] = size
+        self.total_bytes += size
+        self.unscanned_bytes += size
+
+        if self.unscanned_bytes >= self.rescan_bytes:
+            self.scan()
+        self.evict()
+
+    def evict(self):
+        while self.total_bytes > self.max_bytes and len(self.entries) > 1:
+            key, size = self.entries.popitem(last=False)
+            self.total_bytes -= size
+            try:
+                os.remove(self._path(key))
+            except FileNotFoundError:
+                pass
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "entries": len(self.entries),
+            "bytes": self.total_bytes
+        }
@@ -1,157 +1,318 @@
 import os
 import json
-import fitz
-from paddleocr import LayoutDetection
+import numpy as np
+from Document import open_document
+from Models import registry
+from Profiler import profiler
+from collections.abc import Sequence
+
+# Pages of one route as a read-only list, each page dict is built when it is accessed from the positions of the
+# route's boxes, the boxes themselves are the layout results' own dicts (not copies)
+class RouteView(Sequence):
+    def __init__(self, layout_coordinates, index):
+        self.layout_coordinates = layout_coordinates
+        # [(page position, [box positions])]
+        self.index = index
+
+    def __len__(self):
+        return len(self.index)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+
+        page_pos, box_positions = self.index[i]
+        page_data = self.layout_coordinates[page_pos]
+        boxes = page_data["boxes"]
+        return {
+            "input_path": page_data.get("input_path"),
+            "page_idx": page_data.get("page_idx"),
+            "image_size": page_data.get("image_size"),
+            "pdf_size": page_data.get("pdf_size"),
+            "boxes": [boxes[j] for j in box_positions]
+        }
 
 class LayoutDetect:
     TEXT_LABELS = {"text", "title", "reference", "paragraph", "header", "abstract", "table_caption", "table_footnote", "formula_caption","figure_title"}
     TABLE_LABELS = {"table"}
     MATH_LABELS = {"formula", "equation", "inline_formula", "displayed_formula"}
     UNWANTED_LABELS = {"aside_text", "header_image", "footer_image", "formula_number", "number", "seal", "image", "content", "footnote", "chart"}
+    ROUTES = ("text", "table", "math", "vlm")
     
-    def __init__(self, model = "PP-DocLayoutV3"):
-        self.model = LayoutDetection(model_name=model)
+    # Pages are rendered here with PyMuPDF at dpi (144 is what paddle renders PDFs at), cached or not, so turning the
+    # cache on or splitting a document into shards never changes what the model sees.
+    # routes maps labels to "text", "table", "math", "vlm" or None (dropped) on top of the label sets above,
+    # min_scores drops boxes under a score per label or per route (a label's own threshold wins).
+    def __init__(self, model = "PP-DocLayoutV3", threshold=0.2, layout_nms=True, batch_size=4, dpi=144, cache=None, routes=None, min_scores=None):
+        self.model_name = model
+        self.threshold = threshold
+        self.layout_nms = layout_nms
+        self.batch_size = batch_size
+        self.dpi = dpi
+        self.cache = cache
 
-    def detect(self, input_path):
-        output = self.model.predict(input_path, batch_size=4, layout_nms=True, threshold=0.2)
+        self.routes = {
+            **{label: "text" for label in self.TEXT_LABELS},
+            **{label: "table" for label in self.TABLE_LABELS},
+            **{label: "math" for label in self.MATH_LABELS},
+            **{label: None for label in self.UNWANTED_LABELS},
+            **(routes or {})
+        }
+        for label, route in self.routes.items():
+            if route is not None and route not in self.ROUTES:
+                raise ValueError(f"Unknown route {route!r} for label {label!r}")
+        self.min_scores = dict(min_scores or {})
 
-        layout_coordinates = []
-        self.input_path = input_path
+        self.layout_coordinates = None
+        # (page_idx, model result) of the pages the model ran on, kept for their debug images
+        self.model_output = []
+        self.text_coordinates = None
+        self.table_coordinates = None
+        self.math_coordinates = None
+        self.vlm_coordinates = None
 
-        doc = fitz.open(input_path)
+    # Loaded on the first detection and shared with every other LayoutDetect of the process
+    @property
+    def model(self):
+        return registry.get("layout", self.model_name)
 
-        for i, res in enumerate(output):
-            page_json = res.json
-            page = doc[i]
-                    
-            # The model's raw detections (in pixels)
-            raw_boxes = page_json["res"].pop("boxes", [])
-                    
-            # Image dimensions (what the AI saw)
-            img_h, img_w = res["input_img"].shape[:2]
+    # pages is a range of page indices (a shard of the document), None detects every page
+    def detect(self, document, pages=None):
+        with open_document(document) as doc:
+            return self._detect(doc, pages)
 
-            # PDF dimensions (the physical document size)
-            pdf_w = page.rect.width
-            pdf_h = page.rect.height
-                    
-            # Calculate scale factors
-            x_scale, y_scale = pdf_w / img_w, pdf_h / img_h
-
-            processed_boxes = []
-            for order_idx, box_obj in enumerate(raw_boxes):
-                coords = box_obj["coordinate"] # [x1, y1, x2, y2]
-                        
-                # Scale coordinates to PDF points
-                pdf_bbox = [
-                    coords[0] * x_scale, 
-                    coords[1] * y_scale, 
-                    coords[2] * x_scale, 
-                    coords[3] * y_scale
-                ]
-                        
-                processed_boxes.append({
-                    "order": order_idx,
-                    "pdf_bbox": pdf_bbox, 
-                    "box": coords, 
-                    "label": box_obj["label"], 
-                    "score": box_obj["score"], 
-                    "cls_id": box_obj["cls_id"]
-                })
-
-            layout_coordinates.append({
-                "input_path": input_path,
-                "page_idx": i,
-                "image_size": [img_w, img_h],
-                "pdf_size": [float(pdf_w), float(pdf_h)],
-                "boxes": processed_boxes
-            })   
-
-        doc.close()
+    def _detect(self, doc, pages=None):
+        self.input_path = doc.input_path
+
+        layout_coordinates = []
+        output = []
+        for page_data, res in self._pages(doc, pages):
+            layout_coordinates.append(page_data)
+            if res is not None:
+                output.append((page_data["page_idx"], res))
 
         self.layout_coordinates = layout_coordinates
         self.model_output = output
         return layout_coordinates
 
-    def filter(self, layout_coordinates=None):
-        layout_coordinates = self.layout_coordinates
-        
-        text_coordinates = []
-        table_coordinates = []
-        math_coordinates = []
-        
-        for page_data in layout_coordinates:
-            page_base = {
-                "input_path": page_data.get("input_path"),
-                "page_idx": page_data.get("page_idx"),
-                "image_size": page_data.get("image_size"),
-                "pdf_size": page_data.get("pdf_size"),
-            }
-            
-            text_page = {**page_base, "boxes": []}
-            table_page = {**page_base, "boxes": []}
-            math_page = {**page_base, "boxes": []}
-            
-            for box in page_data.get("boxes", []):
-                label = box["label"]
+    # Yields (page_data, model result) as soon as the model is done with a page, nothing is kept after that.
+    # The result (None for cached pages) is only there for the page's debug image.
+    def detect_stream(self, document):
+        with open_document(document) as doc:
+            self.input_path = doc.input_path
+            yield from self._pages(doc)
+
+    # (page_data, model result) in page order, the result is None for pages served from the cache.
+    # Pages go through the model one batch at a time, with a cache only the batch's misses do.
+    def _pages(self, doc, pages=None):
+        pages = pages if pages is not None else range(len(doc))
+        for start in range(0, len(pages), self.batch_size):
+            page_idxs = pages[start:start + self.batch_size]
+            keys, cached = {}, {i: None for i in page_idxs}
+            if self.cache is not None:
+                keys = {i: self.cache.key(doc.content_hash(i), self.model_name, self.threshold, self.layout_nms, self.dpi) for i in page_idxs}
+                cached = {i: self.cache.get(keys[i]) for i in page_idxs}
+
+            computed = {}
+            missing = [i for i in page_idxs if cached[i] is None]
+            if missing:
+                # Paddle expects BGR arrays, the same as cv2.imread gives
+                with profiler.stage("layout.render", pages=len(missing)):
+                    images = [np.ascontiguousarray(doc.render(i, self.dpi)[..., ::-1]) for i in missing]
+                with profiler.stage("layout.predict", pages=len(missing)):
+                    output = self.model.predict(images, batch_size=self.batch_size, layout_nms=self.layout_nms, threshold=self.threshold)
+
+                for i, image, res in zip(missing, images, output):
+                    # Named like paddle names the pages of a PDF it read itself, <name>_<page>_res.png
+                    res["input_path"] = doc.input_path
+                    res["page_index"] = i
+                    page_data = self._page_coordinates(doc, i, res)
+                    self._keep_raster(doc, page_data, image, self.dpi, bgr=True)
+                    if self.cache is not None:
+                        self.cache.put(keys[i], {
+                            "image_size": page_data["image_size"],
+                            "pdf_size": page_data["pdf_size"],
+                            "boxes": page_data["boxes"]
+                        })
+                    computed[i] = (page_data, res)
+
+            for i in page_idxs:
+                if i in computed:
+                    yield computed[i]
+                else:
+                    yield {"input_path": doc.input_path, "page_idx": i, **cached[i]}, None
+
+    # Only pages with a box some crop stage would cut at no more than this DPI are kept, the store knows the policies
+    def _keep_raster(self, doc, page_data, image, dpi, bgr=False):
+        rasters = getattr(doc, "rasters", None)
+        if rasters is None:
+            return
+        if rasters.keeps(page_data["page_idx"], [(self.box_route(box), box) for box in page_data["boxes"]], dpi):
+            rasters.put(page_data["page_idx"], image, dpi, bgr)
+        else:
+            rasters.skipped += 1
+
+    def _page_coordinates(self, doc, i, res):
+        input_path = doc.input_path
+        page_json = res.json
+        page_rect = doc.rect(i)
                 
-                # Skip unwanted labels
-                if label in self.UNWANTED_LABELS:
-                    continue
+        # The model's raw detections (in pixels)
+        raw_boxes = page_json["res"].pop("boxes", [])
                 
-                # Categorize by label type
-                if label in self.TEXT_LABELS:
-                    text_page["boxes"].append(box)
-                elif label in self.TABLE_LABELS:
-                    table_page["boxes"].append(box)
-                elif label in self.MATH_LABELS:
-                    math_page["boxes"].append(box)
-            
-            # Only include pages that have detections
-            if text_page["boxes"]:
-                text_coordinates.append(text_page)
-            if table_page["boxes"]:
-                table_coordinates.append(table_page)
-            if math_page["boxes"]:
-                math_coordinates.append(math_page)
-        
-        self.text_coordinates = text_coordinates
-        self.table_coordinates = table_coordinates
-        self.math_coordinates = math_coordinates
-        
-        return text_coordinates, table_coordinates, math_coordinates
+        # Image dimensions (what the AI saw)
+        img_h, img_w = res["input_img"].shape[:2]
+
+        # PDF dimensions (the physical document size)
+        pdf_w = page_rect.width
+        pdf_h = page_rect.height
+                
+        # Calculate scale factors
+        x_scale, y_scale = pdf_w / img_w, pdf_h / img_h
+
+        processed_boxes = []
+        for order_idx, box_obj in enumerate(raw_boxes):
+            coords = box_obj["coordinate"] # [x1, y1, x2, y2]
+                    
+            # Scale coordinates to PDF points
+            pdf_bbox = [
+                coords[0] * x_scale, 
+                coords[1] * y_scale, 
+                coords[2] * x_scale, 
+                coords[3] * y_scale
+            ]
+                    
+            processed_boxes.append({
+                "order": order_idx,
+                "pdf_bbox": pdf_bbox, 
+                "box": coords, 
+                "label": box_obj["label"], 
+                "score": box_obj["score"], 
+                "cls_id": box_obj["cls_id"]
+            })
+
+        return {
+            "input_path": input_path,
+            "page_idx": i,
+            "image_size": [img_w, img_h],
+            "pdf_size": [float(pdf_w), float(pdf_h)],
+            "boxes": processed_boxes
+        }
+
+    # layout_coordinates can be detect() results, results loaded from a *_layout_coordinates.json or that file's path,
+    # nothing is detected again so boxes can be re-routed without the model. Returns text, table and math views.
+    def filter(self, layout_coordinates=None):
+        views = self.route(layout_coordinates)
+
+        self.text_coordinates = views["text"]
+        self.table_coordinates = views["table"]
+        self.math_coordinates = views["math"]
+        self.vlm_coordinates = views["vlm"]
+
+        return self.text_coordinates, self.table_coordinates, self.math_coordinates
+
+    # {route: RouteView} for every route, pages without boxes for a route are left out of its view
+    def route(self, layout_coordinates=None):
+        if layout_coordinates is None:
+            layout_coordinates = self.layout_coordinates
+        elif isinstance(layout_coordinates, str):
+            with open(layout_coordinates, encoding="utf-8") as f:
+                layout_coordinates = json.load(f)
+        self.layout_coordinates = layout_coordinates
+
+        # Without thresholds a box's route is just its label's
+        box_route = self.box_route if self.min_scores else (lambda box, get=self.routes.get: get(box["label"]))
+
+        index = {route: [] for route in self.ROUTES}
+        for page_pos, page_data in enumerate(layout_coordinates):
+            positions = {}
+            for box_pos, route in enumerate(map(box_route, page_data.get("boxes", ()))):
+                if route is not None:
+                    if route not in positions:
+                        positions[route] = []
+                    positions[route].append(box_pos)
+
+            for route, box_positions in positions.items():
+                index[route].append((page_pos, box_positions))
+
+        return {route: RouteView(layout_coordinates, index[route]) for route in self.ROUTES}
+
+    # Route of one box, None when its label is routed nowhere or its score is under the threshold
+    def box_route(self, box):
+        route = self.routes.get(box["label"])
+        if route is None:
+            return None
+
+        min_score = self.min_scores.get(box["label"], self.min_scores.get(route))
+        if min_score is not None and box.get("score", 1.0) < min_score:
+            return None
+        return route
+
+    # {route: page dict or None} for one page, used when pages are streamed
+    def route_page(self, page_data):
+        page_base = {
+            "input_path": page_data.get("input_path"),
+            "page_idx": page_data.get("page_idx"),
+            "image_size": page_data.get("image_size"),
+            "pdf_size": page_data.get("pdf_size"),
+        }
+
+        boxes = {route: [] for route in self.ROUTES}
+        for box in page_data.get("boxes", []):
+            route = self.box_route(box)
+            if route is not None:
+                boxes[route].append(box)
+
+        return {route: {**page_base, "boxes": boxes[route]} if boxes[route] else None for route in self.ROUTES}
 
     # For visual debugging
+    # Returns the paths of the JSON files it wrote
     def save_results(self, output_path):
         if self.layout_coordinates is None:
-            return
+            return []
 
         os.makedirs(output_path, exist_ok=True)
         
         # Get PDF name from input_path in detection results
         input_path = self.layout_coordinates[0].get("input_path", "output")
         pdf_name = os.path.splitext(os.path.basename(input_path))[0]
-        
-        # Save the photos
-        for res in self.model_output:
-            res.save_to_img(save_path=output_path)
 
         # Save detection results JSON
         detection_path = os.path.join(output_path, f"{pdf_name}_layout_coordinates.json")
         with open(detection_path, "w", encoding="utf-8") as f:
             json.dump(self.layout_coordinates, f, ensure_ascii=False, indent=4)
-        
-        # Save split results if available
-        if self.text_coordinates is not None:
-            text_path = os.path.join(output_path, f"{pdf_name}_text_coordinates.json")
-            with open(text_path, "w", encoding="utf-8") as f:
-                json.dump(self.text_coordinates, f, ensure_ascii=False, indent=4)
-                
-        if self.table_coordinates is not None:
-            table_path = os.path.join(output_path, f"{pdf_name}_table_coordinates.json")
-            with open(table_path, "w", encoding="utf-8") as f:
-                json.dump(self.table_coordinates, f, ensure_ascii=False, indent=4)
-                
-        if self.math_coordinates is not None:
-            math_path = os.path.join(output_path, f"{pdf_name}_math_coordinates.json")
-            with open(math_path, "w", encoding="utf-8") as f:
-                json.dump(self.math_coordinates, f, ensure_ascii=False, indent=4)
\ No newline at end of file
+
+        return [detection_path] + self.save_routes(output_path)
+
+    # The model's page images (boxes drawn on the page) the debug output asks for, written by its writer thread
+    def save_images(self, output_path, debug):
+        os.makedirs(output_path, exist_ok=True)
+        for page_idx, res in self.model_output:
+            if debug.page(page_idx):
+                debug.write(res.save_to_img, save_path=output_path)
+
+    # The per-route JSON files only, enough after re-routing already saved layout results
+    def save_routes(self, output_path):
+        if not self.layout_coordinates:
+            return []
+
+        os.makedirs(output_path, exist_ok=True)
+
+        input_path = self.layout_coordinates[0].get("input_path", "output")
+        pdf_name = os.path.splitext(os.path.basename(input_path))[0]
+
+        written = []
+        sections = [("text", self.text_coordinates), ("table", self.table_coordinates), ("math", self.math_coordinates)]
+        # Nothing is routed to the VLM by default, the file only shows up when something is
+        if self.vlm_coordinates:
+            sections.append(("vlm", self.vlm_coordinates))
+
+        for route, coordinates in sections:
+            if coordinates is None:
+                continue
+            path = os.path.join(output_path, f"{pdf_name}_{route}_coordinates.json")
+            with open(path, "w", encoding="utf-8") as f:
+                json.dump(list(coordinates), f, ensure_ascii=False, indent=4)
+            written.append(path)
+
+        return written
\ No newline at end of file
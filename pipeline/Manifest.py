@@ -0,0 +1,114 @@
+import os
+import json
+import time
+import hashlib
+
+STAGES = ["analyze", "layout", "text", "table", "math", "vlm"]
+
+def file_hash(path, chunk_size=1024 * 1024):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+# Per document record of which stages finished, with what input and where their output went.
+# It is rewritten (atomically) every time a stage starts or finishes, so a run that dies leaves the last finished
+# stage behind and a restart picks up right after it.
+#
+#   {"input_path": ..., "input_hash": <sha256 of the PDF>, "version": 1,
+#    "stages": {"layout": {"status": "done", "input_hash": ..., "outputs": [...], "output_hash": ..., ...}}}
+#
+# A stage's input_hash covers the PDF, the stage settings and the output_hash of the stages it reads from,
+# so a new PDF, a changed setting or a changed upstream output all make it run again.
+class DocumentManifest:
+    VERSION = 1
+
+    def __init__(self, path, input_path, resume=True, rerun=()):
+        self.path = path
+        self.input_path = input_path
+        self.input_hash = file_hash(input_path)
+        self.resume = resume
+        self.rerun = set(rerun)
+        self.stages = {}
+
+        if resume and os.path.exists(path):
+            try:
+                with open(path, encoding="utf-8") as f:
+                    record = json.load(f)
+            except json.JSONDecodeError:
+                record = {}
+            # A different PDF under the same name starts from scratch
+            if record.get("version") == self.VERSION and record.get("input_hash") == self.input_hash:
+                self.stages = record.get("stages", {})
+
+    @staticmethod
+    def path_for(output_path, input_path):
+        pdf_name = os.path.splitext(os.path.basename(input_path))[0]
+        return os.path.join(output_path, f"{pdf_name}_manifest.json")
+
+    def key(self, stage, settings, depends=()):
+        upstream = [self.stages.get(name, {}).get("output_hash") for name in depends]
+        value = json.dumps([self.input_hash, stage, settings, upstream], sort_keys=True)
+        return hashlib.sha256(value.encode("utf-8")).hexdigest()
+
+    # True when the stage can be skipped: finished with this exact input and every output is still on disk
+    def done(self, stage, key):
+        record = self.stages.get(stage)
+        if not self.resume or stage in self.rerun or record is None:
+            return False
+        if record["status"] != "done" or record["input_hash"] != key:
+            return False
+        return all(os.path.exists(path) for path in record["outputs"])
+
+    def start(self, stage, key):
+        self.stages[stage] = {"status": "running", "input_hash": key, "started": time.time()}
+        self.save()
+
+    # info is kept in the record (small results a later stage needs without re-reading the outputs)
+    def complete(self, stage, key, outputs=(), **info):
+        outputs = list(outputs)
+        h = hashlib.sha256(json.dumps(info, sort_keys=True).encode("utf-8"))
+        for path in outputs:
+            h.update(file_hash(path).encode("utf-8"))
+
+        record = self.stages.get(stage, {})
+        self.stages[stage] = {
+            **info,
+            "status": "done",
+            "input_hash": key,
+            "outputs": outputs,
+            "output_hash": h.hexdigest(),
+            "started": record.get("started"),
+            "finished": time.time()
+        }
+        self.save()
+
+    def record(self, stage):
+        return self.stages.get(stage, {})
+
+    # The output of a finished stage whose path ends with suffix
+    def output(self, stage, suffix):
+        return next((path for path in self.record(stage).get("outputs", []) if path.endswith(suffix)), None)
+
+    # default when the stage finished without writing that output (nothing to save)
+    def load(self, stage, suffix, default=None):
+        path = self.output(stage, suffix)
+        if path is None:
+            return default
+        with open(path, encoding="utf-8") as f:
+            return json.load(f)
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+
+        # Write then rename so a crash never leaves half a manifest
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({
+                "input_path": self.input_path,
+                "input_hash": self.input_hash,
+                "version": self.VERSION,
+                "stages": {stage: self.stages[stage] for stage in STAGES if stage in self.stages}
+            }, f, ensure_ascii=False, indent=4)
+        os.replace(tmp_path, self.path)
@@ -0,0 +1,131 @@
+import gc
+import os
+import sys
+import threading
+from collections import OrderedDict
+
+# paddleocr, torch and transformers are only imported inside the loaders, a text-only run never pays for them
+def _load_layout(name):
+    from paddleocr import LayoutDetection
+    return LayoutDetection(model_name=name)
+
+def _load_formula(name):
+    from paddleocr import FormulaRecognition
+    return FormulaRecognition(model_name=name)
+
+def _load_vlm(name):
+    import torch
+    from transformers import AutoModel, AutoTokenizer
+
+    tokenizer = AutoTokenizer.from_pretrained(name, trust_remote_code=True)
+    model = AutoModel.from_pretrained(name, trust_remote_code=True, use_safetensors=True)
+
+    dtype = torch.float16
+    if torch.cuda.is_available():
+        device = "cuda"
+        if torch.cuda.is_bf16_supported():
+            dtype = torch.bfloat16
+    else:
+        device = "cpu"
+
+    model = model.eval().to(device).to(dtype)
+    return {"tokenizer": tokenizer, "model": model, "device": device, "dtype": dtype}
+
+LOADERS = {
+    "layout": _load_layout,
+    "formula": _load_formula,
+    "vlm": _load_vlm,
+}
+
+# Resident set size of this process in bytes, None where /proc is not available
+def current_rss():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, IndexError, ValueError):
+        return None
+
+# Every model is loaded the first time a stage asks for it and then shared by all stages and documents of the process.
+# Least recently used models are unloaded once there are more than max_models or the process is over max_rss_bytes.
+class ModelRegistry:
+    def __init__(self, max_models=None, max_rss_bytes=None):
+        self.max_models = max_models
+        self.max_rss_bytes = max_rss_bytes
+        # RSS an unload did not bring down, nothing more is unloaded for the RSS until it grows past that
+        self.floor_rss = None
+        self.models = OrderedDict()
+        self.lock = threading.RLock()
+
+    def get(self, kind, name):
+        key = (kind, name)
+        with self.lock:
+            if key in self.models:
+                self.models.move_to_end(key)
+                return self.models[key]
+
+            model = LOADERS[kind](name)
+            self.models[key] = model
+            self.evict(keep=key)
+            return model
+
+    # An already built model (or a stand-in with the same interface) served for (kind, name) from now on
+    def put(self, kind, name, model):
+        with self.lock:
+            self.models[(kind, name)] = model
+            self.models.move_to_end((kind, name))
+
+    def loaded(self):
+        with self.lock:
+            return list(self.models)
+
+    # Stages still holding a reference keep their model alive until they let go of it
+    def unload(self, kind=None, name=None):
+        with self.lock:
+            for key in list(self.models):
+                if (kind is None or key[0] == kind) and (name is None or key[1] == name):
+                    del self.models[key]
+        self._release()
+
+    # Over max_models the least recently used ones go until it fits. Over max_rss_bytes they go one at a time for as
+    # long as that brings the RSS down, the allocator often keeps freed memory and unloading more would then only
+    # reload models for every document.
+    def evict(self, keep=None):
+        with self.lock:
+            evicted = False
+            while len(self.models) > 1:
+                too_many = self.max_models is not None and len(self.models) > self.max_models
+                rss = self._over_rss()
+                if not too_many and rss is None:
+                    break
+
+                key = next(k for k in self.models if k != keep)
+                del self.models[key]
+                evicted = True
+                # Freed memory only shows up in the RSS after a collection
+                self._release()
+
+                if not too_many:
+                    after = current_rss()
+                    if after is None or after >= rss:
+                        self.floor_rss = rss
+                        break
+            return evicted
+
+    # The RSS when it is over max_rss_bytes (and past the floor), None otherwise
+    def _over_rss(self):
+        if self.max_rss_bytes is None:
+            return None
+        rss = current_rss()
+        if rss is None or rss <= self.max_rss_bytes:
+            return None
+        if self.floor_rss is not None and rss <= self.floor_rss:
+            return None
+        return rss
+
+    def _release(self):
+        gc.collect()
+        torch = sys.modules.get("torch")
+        if torch is not None and torch.cuda.is_available():
+            torch.cuda.empty_cache()
+
+registry = ModelRegistry()
@@ -0,0 +1,149 @@
+import io
+import os
+import gzip
+import json
+from Analyzer import Analyze
+
+# Compact one-line-per-page output, every box is stored once, column by column:
+#
+#   {"input_path": ..., "version": 1}                                    header
+#   {"page_idx": 0, "image_size": [...], "pdf_size": [...],
+#    "order": [...], "label": [...], "route": [...], "pdf_bbox": [...],
+#    "box": [...], "score": [...], "cls_id": [...], "text": [...],
+#    "duplicate_of": [...]}                                              one per page
+#
+# route is "text", "table", "math", "vlm" or null (filtered out), text is null for boxes that never went
+# through text extraction. duplicate_of is [page_idx, order] for a text box repeating an earlier one
+# (deduplicated runs), null otherwise. A path ending in .gz is gzip compressed.
+
+BOX_COLUMNS = ["order", "pdf_bbox", "box", "label", "score", "cls_id"]
+VERSION = 1
+
+def _open(path, mode):
+    if path.endswith(".gz"):
+        # mtime=0 keeps the output byte for byte reproducible
+        return io.TextIOWrapper(gzip.GzipFile(path, mode + "b", compresslevel=6, mtime=0), encoding="utf-8")
+    return open(path, mode, encoding="utf-8")
+
+class PageWriter:
+    def __init__(self, path, input_path):
+        self.path = path
+        self.input_path = input_path
+
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.file = _open(path, "w")
+        self._write({"input_path": input_path, "version": VERSION})
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _write(self, record):
+        self.file.write(json.dumps(record, ensure_ascii=False, separators=(",", ":")))
+        self.file.write("\n")
+
+    # page_data is a detected page, the other pages are its routed sections, text_page with the extracted text
+    def write_page(self, page_data, text_page=None, table_page=None, math_page=None, vlm_page=None):
+        routes = {}
+        texts = {}
+        duplicates = {}
+        for route, section in (("text", text_page), ("table", table_page), ("math", math_page), ("vlm", vlm_page)):
+            for box in (section or {}).get("boxes", []):
+                routes[box["order"]] = route
+                if "text" in box:
+                    texts[box["order"]] = box["text"]
+                if "duplicate_of" in box:
+                    duplicates[box["order"]] = box["duplicate_of"]
+
+        boxes = page_data.get("boxes", [])
+        record = {
+            "page_idx": page_data["page_idx"],
+            "image_size": page_data.get("image_size"),
+            "pdf_size": page_data.get("pdf_size")
+        }
+        for column in BOX_COLUMNS:
+            record[column] = [box.get(column) for box in boxes]
+        record["route"] = [routes.get(box["order"]) for box in boxes]
+        record["text"] = [texts.get(box["order"]) for box in boxes]
+        if duplicates:
+            record["duplicate_of"] = [duplicates.get(box["order"]) for box in boxes]
+
+        self._write(record)
+
+    def close(self):
+        if not self.file.closed:
+            self.file.close()
+
+# Reads a PageWriter file back one page at a time, every method is a generator that rebuilds
+# the same page dicts the pipeline stages return
+class PageReader:
+    def __init__(self, path):
+        self.path = path
+        with _open(path, "r") as f:
+            header = json.loads(f.readline())
+        self.input_path = header["input_path"]
+        self.version = header["version"]
+
+    def pages(self):
+        with _open(self.path, "r") as f:
+            f.readline()
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+
+    def _page(self, record, boxes):
+        return {
+            "input_path": self.input_path,
+            "page_idx": record["page_idx"],
+            "image_size": record["image_size"],
+            "pdf_size": record["pdf_size"],
+            "boxes": boxes
+        }
+
+    def _boxes(self, record, route=None, with_text=False, empty_only=False):
+        duplicates = record.get("duplicate_of") or [None] * len(record["order"])
+        boxes = []
+        for i in range(len(record["order"])):
+            if route is not None and record["route"][i] != route:
+                continue
+            # A duplicate has no text of its own but it is not an empty region
+            if empty_only and (record["text"][i] != "" or duplicates[i] is not None):
+                continue
+
+            box = {column: record[column][i] for column in BOX_COLUMNS}
+            if with_text:
+                box["text"] = record["text"][i]
+                if duplicates[i] is not None:
+                    box["duplicate_of"] = duplicates[i]
+            boxes.append(box)
+        return boxes
+
+    # LayoutDetect.detect
+    def layout_coordinates(self):
+        for record in self.pages():
+            yield self._page(record, self._boxes(record))
+
+    # One of the LayoutDetect.route outputs, route is "text", "table", "math" or "vlm"
+    def coordinates(self, route):
+        for record in self.pages():
+            boxes = self._boxes(record, route)
+            if boxes:
+                yield self._page(record, boxes)
+
+    # TextExtract.extract, (text results, empty regions)
+    def text_results(self):
+        for record in self.pages():
+            boxes = self._boxes(record, "text", with_text=True)
+            if boxes:
+                yield self._page(record, boxes)
+
+    # Like the pipeline's, a region with an empty region nested in it is left out (Analyze.remove_overlapping_boxes)
+    def text_results_empty(self):
+        for record in self.pages():
+            boxes = self._boxes(record, "text", with_text=True, empty_only=True)
+            drop = Analyze.nested_boxes(boxes)
+            boxes = [box for box, nested in zip(boxes, drop) if not nested]
+            if boxes:
+                yield self._page(record, boxes)
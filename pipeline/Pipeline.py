@@ -0,0 +1,593 @@
+import os
+import json
+import time
+import shutil
+import queue
+import threading
+import hashlib
+import inspect
+from Analyzer import Analyze
+from DebugOutput import DebugOutput
+from Document import DocumentSession
+from LayoutCache import LayoutCache
+from LayoutDetector import LayoutDetect
+from Manifest import DocumentManifest
+from Models import registry
+from PageStore import PageWriter
+from PostProcess import PostProcess
+from Profiler import profiler, aggregate
+from Rasters import PageRasters
+from SectionExtractor import SectionCrop, TextExtract, TableExtract, MathExtract, VLMExtract
+
+# Holds every stage for the lifetime of a worker, run() is called once per PDF
+# (or run_shard() per page range and merge_shards() once all of them are done)
+class Pipeline:
+    # Shards write their output under output_path/.shards until they are merged
+    SHARD_DIR = ".shards"
+
+    def __init__(self, output_path="output", math=False, vlm=False, stream=False, queue_size=8, layout_cache=None, layout_cache_mb=1024, crop_workers=0, crop_inflight_mb=512, math_batch_size=16, pages_output=False, model_memory_mb=None, resume=False, rerun=(), profile_stages=(), dedupe=False, routes=None, min_scores=None, raster_cache_mb=256, table_engine="auto", debug_output="full", debug_every_pages=10, debug_every_documents=1, debug_empty_pages=False):
+        self.output_path = output_path
+        # Re-running one stage resumes every other one from the manifest
+        self.resume = resume or bool(rerun)
+        self.rerun = set(rerun)
+        self.skipped_stages = []
+        self.pages_output = pages_output
+        self.stream = stream
+        self.queue_size = queue_size
+        # Page images of the layout stage kept in memory for the math and VLM crops, past this they spill to a temp file
+        self.raster_cache_mb = raster_cache_mb
+
+        cache = None
+        if layout_cache is not None:
+            cache = LayoutCache(layout_cache, max_bytes=layout_cache_mb * 1024 * 1024)
+
+        # Models are loaded by the registry on first use, least recently used ones are unloaded above model_memory_mb
+        if model_memory_mb is not None:
+            registry.max_rss_bytes = model_memory_mb * 1024 * 1024
+
+        # Stage timings are always collected, profile_stages also run under cProfile (.prof files next to the output)
+        profiler.configure(output_path, profile_stages)
+
+        # Layout page images and crops are debug output, written off the critical path for the pages debug_output
+        # samples (see DebugOutput)
+        self.debug = DebugOutput(debug_output, every_pages=debug_every_pages, every_documents=debug_every_documents, empty_pages=debug_empty_pages)
+
+        self.analyzer = Analyze()
+        # routes/min_scores re-route layout labels (see LayoutDetect), resumed runs re-route without detecting again
+        self.detector = LayoutDetect(cache=cache, routes=routes, min_scores=min_scores)
+        # dedupe: regions repeated across pages (headers, footers, stamps) are read once and referenced after that
+        self.text_extractor = TextExtract(dedupe=dedupe)
+        # Born-digital tables are rebuilt from the PDF, only the others are cropped for the structure model
+        # crop_workers render processes are shared by the three, at most crop_inflight_mb of their crops wait to be taken
+        crop_inflight_bytes = crop_inflight_mb * 1024 * 1024
+        self.table_extractor = TableExtract(crop_workers=crop_workers, engine=table_engine, crop_inflight_bytes=crop_inflight_bytes)
+        self.math_extractor = MathExtract(crop_workers=crop_workers, batch_size=math_batch_size, crop_inflight_bytes=crop_inflight_bytes) if math else None
+        self.vlm_extractor = VLMExtract(crop_workers=crop_workers, dedupe=dedupe, crop_inflight_bytes=crop_inflight_bytes) if vlm else None
+
+    def run(self, input_path):
+        start = time.perf_counter()
+        self.skipped_stages = []
+        pdf_name = os.path.splitext(os.path.basename(input_path))[0]
+        profiler.reset(pdf_name)
+        self.debug.start(pdf_name)
+
+        manifest = DocumentManifest(DocumentManifest.path_for(self.output_path, input_path), input_path, self.resume, self.rerun)
+
+        # Every stage shares this one open PDF instead of re-opening input_path
+        with DocumentSession(input_path) as document:
+            document.rasters = self.page_rasters()
+            # Per page route, only pages with a text layer go through PyMuPDF, scanned pages end up as empty regions for the VLM
+            key = manifest.key("analyze", self.settings("analyze"))
+            if self.skip(manifest, "analyze", key):
+                routes = manifest.record("analyze")["routes"]
+            else:
+                manifest.start("analyze", key)
+                with profiler.stage("analyze", pages=len(document)):
+                    routes = self.analyzer.triage(document)
+                manifest.complete("analyze", key, routes=routes)
+            no_text_pages = {i for i, route in enumerate(routes) if route in (Analyze.SCANNED, Analyze.EMPTY)}
+            if document.rasters is not None:
+                document.rasters.empty_pages = no_text_pages
+
+            misaligned_pages = set()
+            if self.has_regions(routes, no_text_pages):
+                status = "done"
+                # A finished layout stage is read back instead of streamed
+                layout_key = manifest.key("layout", self.settings("layout"), ["analyze"])
+                if self.stream and not manifest.done("layout", layout_key):
+                    misaligned_pages = self.extract_stream(document, manifest, no_text_pages)
+                else:
+                    misaligned_pages = self.extract(document, manifest, no_text_pages)
+            else:
+                status = "no_text"
+                print(f"No text found in {input_path}.")
+
+            # The crops the debug images are cut from may still be views of this document's page images
+            with profiler.stage("debug.flush"):
+                self.debug.flush()
+
+            pages = len(document)
+            rasters = document.rasters.stats() if document.rasters is not None else None
+
+        result = {
+            "input_path": input_path,
+            "status": status,
+            "pages": pages,
+            "routes": {route: routes.count(route) for route in set(routes)},
+            "misaligned_pages": len(misaligned_pages),
+            "skipped_stages": self.skipped_stages,
+            "seconds": time.perf_counter() - start
+        }
+        if self.detector.cache is not None:
+            result["layout_cache"] = self.detector.cache.stats()
+        if rasters is not None:
+            result["page_rasters"] = rasters
+        registry.evict()
+
+        result["profile"] = profiler.report()
+        self.save_profile(pdf_name, result)
+        return result
+
+    # Whether the layout and everything after it run: a document with a text layer always, a fully scanned one only
+    # when the VLM can read its regions, one with only empty pages never
+    def has_regions(self, routes, no_text_pages):
+        if len(no_text_pages) < len(routes):
+            return True
+        return self.vlm_extractor is not None and Analyze.SCANNED in routes
+
+    # One page range [start, stop) of a document through the stages that look at one page at a time (analyze,
+    # layout, text, table), written to the shard's own directory. merge_shards puts the shards of a document back
+    # together and runs the stages that batch over pages (math, VLM) and the pages output on the whole document.
+    def run_shard(self, input_path, start, stop):
+        started = time.time()
+        begin = time.perf_counter()
+        pdf_name = os.path.splitext(os.path.basename(input_path))[0]
+        profiler.reset(pdf_name)
+        self.debug.start(pdf_name)
+        shard_path = self.shard_path(pdf_name, start)
+        pages = range(start, stop)
+
+        outputs = {}
+        # No page rasters, the math and VLM crops are cut in merge_shards, in another process
+        with DocumentSession(input_path) as document:
+            with profiler.stage("analyze", pages=len(pages)):
+                routes = self.analyzer.triage(document, pages)
+            no_text_pages = {i for i, route in zip(pages, routes) if route in (Analyze.SCANNED, Analyze.EMPTY)}
+
+            # Whether the document has any text at all is only known once every shard is in, the layout always runs
+            with profiler.stage("layout", pages=len(pages)):
+                layout_coordinates = self.detector.detect(document, pages)
+            with profiler.stage("layout.filter", pages=len(layout_coordinates)):
+                text_coordinates, table_coordinates, _ = self.detector.filter(layout_coordinates)
+            outputs["layout"] = self.detector.save_results(shard_path)
+
+            _, text_results_empty, misaligned_pages = self.extract_text(document, layout_coordinates, text_coordinates, no_text_pages)
+            outputs["text"] = self.text_extractor.save_results(shard_path)
+            self.debug.mark_empty(text_results_empty)
+            self.detector.save_images(shard_path, self.debug)
+
+            with profiler.stage("table", pages=len(table_coordinates), boxes=self.box_count(table_coordinates)):
+                self.table_extractor.extract(table_coordinates, document)
+            outputs["table"] = self.table_extractor.save_results(shard_path, self.debug)
+            with profiler.stage("debug.flush"):
+                self.debug.flush()
+
+        registry.evict()
+        return {
+            "input_path": input_path,
+            "status": "shard",
+            "start": start,
+            "stop": stop,
+            "routes": routes,
+            "misaligned_pages": sorted(misaligned_pages),
+            "outputs": outputs,
+            "profile": profiler.report(),
+            "started": started,
+            "seconds": time.perf_counter() - begin
+        }
+
+    # The output of the shards as if the document had run whole: per page JSON concatenated in page order,
+    # images moved over, the manifest recorded as a whole document run would have.
+    # The document's seconds count from when its first shard started.
+    def merge_shards(self, input_path, shards):
+        self.skipped_stages = []
+        pdf_name = os.path.splitext(os.path.basename(input_path))[0]
+        profiler.reset(pdf_name)
+        self.debug.start(pdf_name)
+        shards = sorted(shards, key=lambda shard: shard["start"])
+
+        manifest = DocumentManifest(DocumentManifest.path_for(self.output_path, input_path), input_path, self.resume, self.rerun)
+        routes = [route for shard in shards for route in shard["routes"]]
+        manifest.complete("analyze", manifest.key("analyze", self.settings("analyze")), routes=routes)
+        no_text_pages = {i for i, route in enumerate(routes) if route in (Analyze.SCANNED, Analyze.EMPTY)}
+
+        misaligned_pages = set()
+        with DocumentSession(input_path) as document:
+            if self.has_regions(routes, no_text_pages):
+                status = "done"
+                misaligned_pages = {i for shard in shards for i in shard["misaligned_pages"]}
+                for stage, depends in (("layout", ["analyze"]), ("text", ["analyze", "layout"]), ("table", ["layout"])):
+                    key = manifest.key(stage, self.settings(stage), depends)
+                    outputs = self.merge_outputs([shard["outputs"][stage] for shard in shards])
+                    info = {"misaligned_pages": sorted(misaligned_pages)} if stage == "text" else {}
+                    manifest.complete(stage, key, outputs, **info)
+                self.merge_images(pdf_name, shards)
+
+                layout_coordinates = manifest.load("layout", "_layout_coordinates.json", [])
+                text_results = manifest.load("text", "_text_results.json", [])
+                text_results_empty = manifest.load("text", "_text_empty_coordinates.json", [])
+                with profiler.stage("layout.filter", pages=len(layout_coordinates)):
+                    _, _, math_coordinates = self.detector.filter(layout_coordinates)
+
+                # The tables were done in the shards
+                self.debug.mark_empty(text_results_empty)
+                self.extract_sections(document, manifest, text_results_empty, None, math_coordinates, self.detector.vlm_coordinates)
+                self.write_pages(document, layout_coordinates, text_results)
+            else:
+                status = "no_text"
+                print(f"No text found in {input_path}.")
+
+            with profiler.stage("debug.flush"):
+                self.debug.flush()
+
+            pages = len(document)
+
+        self.discard_shards(input_path, shards)
+
+        result = {
+            "input_path": input_path,
+            "status": status,
+            "pages": pages,
+            "shards": len(shards),
+            "routes": {route: routes.count(route) for route in set(routes)},
+            "misaligned_pages": len(misaligned_pages),
+            "skipped_stages": self.skipped_stages,
+            "seconds": time.time() - min(shard["started"] for shard in shards)
+        }
+        registry.evict()
+
+        # The shards' stage totals with the merge's own stages on top
+        stages = aggregate([shard["profile"] for shard in shards] + [profiler.report()])
+        for entry in stages.values():
+            entry.pop("documents", None)
+        result["profile"] = stages
+        self.save_profile(pdf_name, result)
+        return result
+
+    # The store math and VLM crops are cut from, None when nothing would be. Table crops are rendered above the layout
+    # DPI, each route is judged by the policy of the extractor that crops it (empty text regions go to the VLM).
+    def page_rasters(self):
+        policies = {}
+        if self.math_extractor is not None:
+            policies["math"] = self.math_extractor.dpi_policy
+        if self.vlm_extractor is not None:
+            policies["vlm"] = policies["text"] = self.vlm_extractor.dpi_policy
+        if not self.raster_cache_mb or not policies:
+            return None
+        return PageRasters(max_bytes=self.raster_cache_mb * 1024 * 1024, policies=policies)
+
+    def shard_path(self, pdf_name, start):
+        return os.path.join(self.output_path, self.SHARD_DIR, f"{pdf_name}_{start}")
+
+    # Whatever the shards of a document left in their directories, after a merge or when one of them failed
+    def discard_shards(self, input_path, shards):
+        pdf_name = os.path.splitext(os.path.basename(input_path))[0]
+        for shard in shards:
+            shutil.rmtree(self.shard_path(pdf_name, shard["start"]), ignore_errors=True)
+        try:
+            os.rmdir(os.path.join(self.output_path, self.SHARD_DIR))
+        except OSError:
+            pass
+
+    # One stage's JSON outputs of every shard (in page order) concatenated into output_path. Returns the written paths.
+    def merge_outputs(self, shard_outputs):
+        lists = {}
+        for outputs in shard_outputs:
+            for path in outputs:
+                with open(path, encoding="utf-8") as f:
+                    lists.setdefault(os.path.basename(path), []).extend(json.load(f))
+
+        os.makedirs(self.output_path, exist_ok=True)
+        written = []
+        for name, items in lists.items():
+            path = os.path.join(self.output_path, name)
+            with open(path, "w", encoding="utf-8") as f:
+                json.dump(items, f, ensure_ascii=False, indent=4)
+            written.append(path)
+        return written
+
+    # The shards' debug images, every one is named by its page in the document already
+    def merge_images(self, pdf_name, shards):
+        for shard in shards:
+            shard_path = self.shard_path(pdf_name, shard["start"])
+            for name in os.listdir(shard_path):
+                if name.endswith(".png"):
+                    os.replace(os.path.join(shard_path, name), os.path.join(self.output_path, name))
+
+    # Per document stage report, and the cProfile dumps of the profiled stages
+    def save_profile(self, pdf_name, result):
+        os.makedirs(self.output_path, exist_ok=True)
+        profile_path = os.path.join(self.output_path, f"{pdf_name}_profile.json")
+        with open(profile_path, "w", encoding="utf-8") as f:
+            json.dump({
+                "input_path": result["input_path"],
+                "pages": result["pages"],
+                "seconds": result["seconds"],
+                "stages": result["profile"]
+            }, f, ensure_ascii=False, indent=4)
+        profiler.dump_profiles()
+
+    # Everything that changes a stage's output besides the PDF and the stages before it
+    def settings(self, stage):
+        # Re-routing changes what every stage after the layout gets
+        routing = [sorted(self.detector.routes.items()), sorted(self.detector.min_scores.items())]
+
+        if stage == "analyze":
+            return [Analyze.MIXED_IMAGE_COVERAGE]
+        if stage == "layout":
+            return [self.detector.model_name, self.detector.threshold, self.detector.layout_nms, self.detector.dpi]
+        if stage == "text":
+            # Any edit to the normalization rules re-runs text extraction
+            rules = hashlib.sha256(inspect.getsource(PostProcess).encode("utf-8")).hexdigest()
+            return [routing, rules, self.text_extractor.dedupe, Analyze.ALIGNMENT_IOW, Analyze.ALIGNED_WORDS, Analyze.MIN_WORDS, Analyze.NESTED_CONTAINMENT]
+        if stage == "table":
+            return [routing, vars(self.table_extractor.dpi_policy or SectionCrop.DEFAULT_POLICY), self.table_extractor.engine, self.table_extractor.native.settings()]
+        if stage == "math":
+            return [routing, self.math_extractor.model_name, vars(self.math_extractor.dpi_policy)]
+        if stage == "vlm":
+            return [routing, self.vlm_extractor.model_name, vars(self.vlm_extractor.dpi_policy), self.vlm_extractor.dedupe]
+
+    @staticmethod
+    def box_count(coordinates):
+        return sum(len(page_data["boxes"]) for page_data in coordinates)
+
+    def skip(self, manifest, stage, key):
+        if manifest.done(stage, key):
+            self.skipped_stages.append(stage)
+            return True
+        return False
+
+    # Compact one-line-per-page output next to the debugging JSON, None when it is turned off
+    def page_writer(self, document):
+        if not self.pages_output:
+            return None
+        pdf_name = os.path.splitext(os.path.basename(document.input_path))[0]
+        return PageWriter(os.path.join(self.output_path, f"{pdf_name}_pages.ndjson.gz"), document.input_path)
+
+    # Returns the pages whose text layer did not line up with the layout, they were extracted as empty regions.
+    # Stages the manifest marks as finished are read back from their output files instead of run again.
+    def extract(self, document, manifest, no_text_pages=()):
+        output_path = self.output_path
+
+        key = manifest.key("layout", self.settings("layout"), ["analyze"])
+        if self.skip(manifest, "layout", key):
+            layout_coordinates = manifest.load("layout", "_layout_coordinates.json")
+            self.detector.model_output = []
+            with profiler.stage("layout.filter", pages=len(layout_coordinates)):
+                text_coordinates, table_coordinates, math_coordinates = self.detector.filter(layout_coordinates)
+            # The routing may have changed since the layout was saved
+            self.detector.save_routes(output_path) # For visual debugging
+        else:
+            manifest.start("layout", key)
+            with profiler.stage("layout", pages=len(document)):
+                layout_coordinates = self.detector.detect(document)
+            with profiler.stage("layout.filter", pages=len(layout_coordinates)):
+                text_coordinates, table_coordinates, math_coordinates = self.detector.filter(layout_coordinates)
+            outputs = self.detector.save_results(output_path) # For visual debugging
+            manifest.complete("layout", key, outputs)
+
+        text_results, text_results_empty = [], []
+        misaligned_pages = set()
+
+        # <section>_coordinates are never truly empty so create functions that check them
+        if text_coordinates is not None:
+            key = manifest.key("text", self.settings("text"), ["analyze", "layout"])
+            if self.skip(manifest, "text", key):
+                text_results = manifest.load("text", "_text_results.json", [])
+                text_results_empty = manifest.load("text", "_text_empty_coordinates.json", [])
+                misaligned_pages = set(manifest.record("text")["misaligned_pages"])
+            else:
+                manifest.start("text", key)
+                text_results, text_results_empty, misaligned_pages = self.extract_text(document, layout_coordinates, text_coordinates, no_text_pages)
+                outputs = self.text_extractor.save_results(output_path) # For visual debugging
+                manifest.complete("text", key, outputs, misaligned_pages=sorted(misaligned_pages))
+
+        # Written once the text stage tells which pages have empty regions
+        self.debug.mark_empty(text_results_empty)
+        self.detector.save_images(output_path, self.debug) # For visual debugging
+
+        vlm_coordinates = self.detector.vlm_coordinates
+        self.extract_sections(document, manifest, text_results_empty, table_coordinates, math_coordinates, vlm_coordinates)
+        self.write_pages(document, layout_coordinates, text_results)
+
+        return misaligned_pages
+
+    # Text of the text regions, pages whose text layer does not line up with the layout are left as empty regions.
+    # Returns (text results, empty regions, misaligned pages), the extractor keeps them for save_results.
+    def extract_text(self, document, layout_coordinates, text_coordinates, no_text_pages=()):
+        with profiler.stage("text", pages=len(text_coordinates), boxes=self.box_count(text_coordinates)):
+            with profiler.stage("text.alignment", pages=len(layout_coordinates)):
+                misaligned_pages = self.analyzer.misaligned_pages(document, layout_coordinates, no_text_pages)
+            no_text_pages = set(no_text_pages) | misaligned_pages
+
+            text_results, text_results_empty = self.text_extractor.extract(text_coordinates, document, no_text_pages)
+            # Only the inner boxes of nested empty regions go to re-OCR
+            text_results_empty = self.analyzer.remove_overlapping_boxes(text_results_empty)
+        self.text_extractor.empty_regions = text_results_empty
+        return text_results, text_results_empty, misaligned_pages
+
+    # The pages output of a whole document, the routed sections come from the detector's last filter
+    def write_pages(self, document, layout_coordinates, text_results):
+        writer = self.page_writer(document)
+        if writer is None:
+            return
+
+        with writer:
+            text_pages = {p["page_idx"]: p for p in text_results}
+            table_pages = {p["page_idx"]: p for p in self.detector.table_coordinates}
+            math_pages = {p["page_idx"]: p for p in self.detector.math_coordinates}
+            vlm_pages = {p["page_idx"]: p for p in self.detector.vlm_coordinates}
+            for page_data in layout_coordinates:
+                page_idx = page_data["page_idx"]
+                writer.write_page(page_data, text_pages.get(page_idx), table_pages.get(page_idx), math_pages.get(page_idx), vlm_pages.get(page_idx))
+
+    # VLM, table and math stages, they only need the layout and text results.
+    # The VLM reads the empty text regions and whatever the routing sends to it directly.
+    def extract_sections(self, document, manifest, text_results_empty, table_coordinates, math_coordinates, vlm_coordinates=()):
+        output_path = self.output_path
+
+        vlm_regions = list(text_results_empty) + list(vlm_coordinates)
+        if self.vlm_extractor is not None and vlm_regions:
+            key = manifest.key("vlm", self.settings("vlm"), ["layout", "text"])
+            if not self.skip(manifest, "vlm", key):
+                manifest.start("vlm", key)
+                with profiler.stage("vlm", pages=len(vlm_regions), boxes=self.box_count(vlm_regions)):
+                    self.vlm_extractor.partial_extract(vlm_regions, document)
+                outputs = self.vlm_extractor.save_results(output_path, self.debug) # For visual debugging
+                manifest.complete("vlm", key, outputs)
+
+        if table_coordinates is not None:
+            key = manifest.key("table", self.settings("table"), ["layout"])
+            if not self.skip(manifest, "table", key):
+                manifest.start("table", key)
+                with profiler.stage("table", pages=len(table_coordinates), boxes=self.box_count(table_coordinates)):
+                    self.table_extractor.extract(table_coordinates, document)
+                outputs = self.table_extractor.save_results(output_path, self.debug) # For visual debugging
+                manifest.complete("table", key, outputs)
+
+        if self.math_extractor is not None and math_coordinates:
+            key = manifest.key("math", self.settings("math"), ["layout"])
+            if not self.skip(manifest, "math", key):
+                manifest.start("math", key)
+                with profiler.stage("math", pages=len(math_coordinates), boxes=self.box_count(math_coordinates)):
+                    self.math_extractor.extract(math_coordinates, document)
+                outputs = self.math_extractor.save_results(output_path) # For visual debugging
+                manifest.complete("math", key, outputs)
+
+    # Layout detection runs in a background thread and hands pages over through a bounded queue,
+    # filtering and text extraction work on page i while the model is already on page i+1
+    def extract_stream(self, document, manifest, no_text_pages=()):
+        output_path = self.output_path
+        self.text_extractor.reset()
+        pages = queue.Queue(maxsize=self.queue_size)
+        done = object()
+        failure = []
+
+        # Layout and text finish together here
+        layout_key = manifest.key("layout", self.settings("layout"), ["analyze"])
+        manifest.start("layout", layout_key)
+
+        # Set when the consumer is done, also when it failed, the producer stops instead of waiting on a full queue
+        stop = threading.Event()
+
+        def hand_over(item):
+            while not stop.is_set():
+                try:
+                    pages.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def produce():
+            try:
+                # Includes the time blocked on a full queue, the consumer's text stage overlaps it
+                with profiler.stage("layout", pages=0) as counters:
+                    for page_data, res in self.detector.detect_stream(document):
+                        counters["pages"] += 1
+                        # The model result only goes along when the page's debug image may be written
+                        if not hand_over((page_data, res if self.debug.document else None)):
+                            break
+            except Exception as e:
+                failure.append(e)
+            finally:
+                hand_over(done)
+
+        producer = threading.Thread(target=produce, daemon=True)
+        producer.start()
+
+        layout_coordinates = []
+        text_coordinates, table_coordinates, math_coordinates, vlm_coordinates = [], [], [], []
+        text_results, text_results_empty = [], []
+        misaligned_pages = set()
+        writer = self.page_writer(document)
+        os.makedirs(output_path, exist_ok=True)
+
+        try:
+            while True:
+                item = pages.get()
+                if item is done:
+                    break
+                page_data, res = item
+
+                layout_coordinates.append(page_data)
+                with profiler.stage("layout.filter", pages=1):
+                    routed = self.detector.route_page(page_data)
+                text_page, table_page, math_page, vlm_page = routed["text"], routed["table"], routed["math"], routed["vlm"]
+
+                page_result = None
+                if text_page is not None:
+                    text_coordinates.append(text_page)
+                    with profiler.stage("text", pages=1, boxes=len(text_page["boxes"])):
+                        has_text = page_data["page_idx"] not in no_text_pages
+                        if has_text:
+                            with profiler.stage("text.alignment", pages=1):
+                                aligned = self.analyzer.is_aligned(document, page_data)
+                            if not aligned:
+                                misaligned_pages.add(page_data["page_idx"])
+                                has_text = False
+                        page_result, page_empty = self.text_extractor.extract_page(text_page, document, has_text)
+                        text_results.append(page_result)
+                        if page_empty is not None:
+                            page_empty = self.analyzer.remove_overlapping_boxes([page_empty])
+                            text_results_empty.extend(page_empty)
+                            self.debug.mark_empty(page_empty)
+                if table_page is not None:
+                    table_coordinates.append(table_page)
+                if math_page is not None:
+                    math_coordinates.append(math_page)
+                if vlm_page is not None:
+                    vlm_coordinates.append(vlm_page)
+
+                # Written as soon as the page is done
+                if writer is not None:
+                    writer.write_page(page_data, page_result, table_page, math_page, vlm_page)
+                # For visual debugging, queued now since res is dropped after this page
+                if res is not None and self.debug.page(page_data["page_idx"]):
+                    self.debug.write(res.save_to_img, save_path=output_path)
+        finally:
+            stop.set()
+            # Whatever the producer queued (page images included) is dropped, then it sees the stop and exits
+            while True:
+                try:
+                    pages.get_nowait()
+                except queue.Empty:
+                    break
+            producer.join()
+            if writer is not None:
+                writer.close()
+        if failure:
+            raise failure[0]
+
+        # Only the small per-box dicts are kept, the page images were dropped as soon as each page was done
+        self.detector.layout_coordinates = layout_coordinates
+        self.detector.model_output = []
+        self.detector.text_coordinates = text_coordinates
+        self.detector.table_coordinates = table_coordinates
+        self.detector.math_coordinates = math_coordinates
+        self.detector.vlm_coordinates = vlm_coordinates
+        outputs = []
+        if layout_coordinates:
+            outputs = self.detector.save_results(output_path) # For visual debugging
+        manifest.complete("layout", layout_key, outputs)
+
+        self.text_extractor.input_path = document.input_path
+        self.text_extractor.extracted_text = text_results
+        self.text_extractor.empty_regions = text_results_empty
+        outputs = self.text_extractor.save_results(output_path) # For visual debugging
+        text_key = manifest.key("text", self.settings("text"), ["analyze", "layout"])
+        manifest.complete("text", text_key, outputs, misaligned_pages=sorted(misaligned_pages))
+
+        self.extract_sections(document, manifest, text_results_empty, table_coordinates, math_coordinates, vlm_coordinates)
+
+        return misaligned_pages
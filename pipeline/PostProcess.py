@@ -34,17 +34,73 @@ class PostProcess:
             '■': '-', '□': '-', '◆': '-', '◇': '-',
         }
 
+        # Invisible characters that are dropped and Unicode spaces that become a regular space
+        self.CONTROL_CHARS = [chr(c) for c in [*range(0x00, 0x09), 0x0b, 0x0c, *range(0x0e, 0x20)]]
+        self.SOFT_HYPHENS = ['\u00AD', '\u200B', '\u200C', '\u200D', '\uFEFF']
+        self.SPACES = ['\u00A0', *map(chr, range(0x2000, 0x200B)), '\u202F', '\u205F', '\u3000']
+
+        # Every character map above is applied in this order, compiled once into as few passes as possible
+        replacements = [
+            *((char, '') for char in self.CONTROL_CHARS),
+            *((char, '') for char in self.SOFT_HYPHENS),
+            *self.LIGATURES.items(),
+            *self.QUOTES.items(),
+            *self.DASHES.items(),
+            *self.BULLETS.items(),
+            *((char, ' ') for char in self.SPACES),
+        ]
+        self.char_passes = self._compile_char_passes(replacements)
+
+        self.multi_space_re = re.compile(r' {2,}')
+        self.line_ending_re = re.compile(r'\r\n?')
+        self.multi_newline_re = re.compile(r'\n{3,}')
+        # Only the last letter before the hyphen is captured, a leading \w+ finds the same matches
+        # but backtracks over every word on the page
+        self.hyphen_newline_re = re.compile(r'(\w)-\n(\w+)')
+        self.hyphen_space_re = re.compile(r'(\w)-\s+([a-z])')
+        self.punct_letter_re = re.compile(r'([.!?])(\w)')
+        self.space_before_punct_re = re.compile(r'\s+([.!?,;:])')
+        self.comma_letter_re = re.compile(r'([,;])(\w)')
+
+    @staticmethod
+    def _compile_char_passes(replacements):
+        """Group ordered replacements into str.translate tables.
+
+        Consecutive single-character replacements share one table unless an earlier
+        output contains a later key (the sequential result would differ). Multi-character
+        keys stay a separate str.replace pass, in their original position. Each table
+        comes with a character class so text without any of its keys skips the translate.
+        """
+        passes = []
+        table = {}
+        produced = set()
+
+        def flush():
+            if table:
+                finder = re.compile('[' + ''.join(re.escape(key) for key in table) + ']')
+                passes.append((finder, str.maketrans(table)))
+
+        for key, value in replacements:
+            if key == value:
+                continue
+            if len(key) != 1 or key in produced:
+                flush()
+                table, produced = {}, set()
+                if len(key) != 1:
+                    passes.append((key, value))
+                    continue
+            table.setdefault(key, value)
+            produced.update(value)
+
+        flush()
+        return passes
+
     def process(self, text):
         # 1. Low-level Unicode cleanup
         text = unicodedata.normalize('NFKC', text)
-        text = self._remove_control_chars(text)
-        text = self._remove_soft_hyphens(text)
         
-        # 2. Character normalization
-        text = self._normalize_ligatures(text)
-        text = self._normalize_quotes(text)
-        text = self._normalize_dashes(text)
-        text = self._normalize_bullets(text)
+        # 2. Character normalization (control chars, soft hyphens, ligatures, quotes, dashes, bullets, spaces)
+        text = self._normalize_chars(text)
         
         # 3. Whitespace cleanup
         text = self._normalize_whitespace(text)
@@ -55,75 +111,54 @@ class PostProcess:
         
         return text
     
-    def _remove_control_chars(self, text):
-        """Remove invisible control characters (U+0000 to U+001F, except newline/tab)."""
-        return re.sub(r'[\x00-\x08\x0b\x0c\x0e-\x1f]', '', text)
-    
-    def _remove_soft_hyphens(self, text):
-        """Remove soft hyphens and other invisible formatting chars."""
-        return re.sub(r'[\u00AD\u200B\u200C\u200D\uFEFF]', '', text)
-    
-    def _normalize_ligatures(self, text):
-        """Expand typographic ligatures to their base characters."""
-        for lig, expansion in self.LIGATURES.items():
-            text = text.replace(lig, expansion)
-        return text
-    
-    def _normalize_quotes(self, text):
-        """Convert fancy quotes to standard ASCII quotes."""
-        for fancy, standard in self.QUOTES.items():
-            text = text.replace(fancy, standard)
-        return text
-    
-    def _normalize_dashes(self, text):
-        """Normalize various dash characters."""
-        for dash, standard in self.DASHES.items():
-            text = text.replace(dash, standard)
-        return text
-    
-    def _normalize_bullets(self, text):
-        """Standardize bullet point characters."""
-        for bullet, standard in self.BULLETS.items():
-            text = text.replace(bullet, standard)
+    def _normalize_chars(self, text):
+        """Apply all character maps, one str.translate per compiled pass."""
+        for match, change in self.char_passes:
+            if isinstance(match, str):
+                text = text.replace(match, change)
+            elif match.search(text):
+                text = text.translate(change)
         return text
     
     def _normalize_whitespace(self, text):
         """Normalize all whitespace characters."""
-        # Unicode spaces → regular space
-        text = re.sub(r'[\u00A0\u2000-\u200A\u202F\u205F\u3000]', ' ', text)
+        # Unicode spaces → regular space is done by _normalize_chars
         # Collapse multiple spaces
-        text = re.sub(r' +', ' ', text)
+        text = self.multi_space_re.sub(' ', text)
         # Normalize line endings
-        text = re.sub(r'\r\n?', '\n', text)
+        if '\r' in text:
+            text = self.line_ending_re.sub('\n', text)
         # Collapse multiple newlines to max 2
-        text = re.sub(r'\n{3,}', '\n\n', text)
+        if '\n\n\n' in text:
+            text = self.multi_newline_re.sub('\n\n', text)
         return text.strip()
     
     def _heal_hyphenation(self, text):
         """Rejoin words split by hyphenation at line breaks."""
+        if '-' not in text:
+            return text
         # "exam-\nple" → "example"
-        text = re.sub(r'(\w+)-\n(\w+)', r'\1\2', text)
+        if '-\n' in text:
+            text = self.hyphen_newline_re.sub(r'\1\2', text)
         # "exam- ple" → "example"
-        text = re.sub(r'(\w+)-\s+([a-z])', r'\1\2', text)
+        text = self.hyphen_space_re.sub(r'\1\2', text)
         return text
     
+    @staticmethod
+    def _add_space_after_punct(match):
+        punct = match.group(1)
+        next_char = match.group(2)
+        # Check if next char is uppercase in any language
+        if unicodedata.category(next_char) == 'Lu':
+            return punct + ' ' + next_char
+        return match.group(0)
+    
     def _fix_punctuation_spacing(self, text):
         """Ensure proper spacing around punctuation."""
         # Add space after . ! ? if followed by uppercase (any language)
-        # Use function to check Unicode category for uppercase letters
-        def add_space_after_punct(match):
-            punct = match.group(1)
-            next_char = match.group(2)
-            # Check if next char is uppercase in any language
-            if unicodedata.category(next_char) == 'Lu':
-                return punct + ' ' + next_char
-            return match.group(0)
-        
-        # Match punctuation followed by any letter
-        text = re.sub(r'([.!?])(\w)', add_space_after_punct, text)
+        text = self.punct_letter_re.sub(self._add_space_after_punct, text)
         # Remove space before punctuation
-        text = re.sub(r'\s+([.!?,;:])', r'\1', text)
+        text = self.space_before_punct_re.sub(r'\1', text)
         # Ensure space after comma/semicolon if followed by letter (any language)
-        text = re.sub(r'([,;])(\w)', r'\1 \2', text)
-        return text
-
+        text = self.comma_letter_re.sub(r'\1 \2', text)
+        return text
\ No newline at end of file
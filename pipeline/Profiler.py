@@ -0,0 +1,115 @@
+import os
+import time
+import cProfile
+import resource
+import threading
+from contextlib import contextmanager
+from Manifest import STAGES
+
+# Wall and CPU time, call count, peak RSS and whatever counters the caller adds (pages, boxes, pixels) per stage.
+# Stages nest by name ("text" and "text.post_process"), calls with the same name add up.
+# CPU time is for the whole process, stages that overlap in --stream mode share it.
+class StageProfiler:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.profile_dir = None
+        self.profile_stages = set()
+        self.reset()
+
+    # Stages named in profile_stages also run under cProfile, one <document>_<stage>.prof per document in profile_dir
+    def configure(self, profile_dir=None, profile_stages=()):
+        self.profile_dir = profile_dir
+        self.profile_stages = set(profile_stages)
+
+    def reset(self, document_name=None):
+        with self.lock:
+            self.document_name = document_name
+            self.stages = {}
+            self.profiles = {}
+
+    # Yields a dict the caller can add counters to while the stage runs.
+    # The thread is renamed after the stage, so a py-spy dump shows which stage every thread is in.
+    @contextmanager
+    def stage(self, name, **counters):
+        thread = threading.current_thread()
+        thread_name = thread.name
+        thread.name = f"{thread_name}:{name}"
+
+        profile = self._profile(name)
+        wall = time.perf_counter()
+        cpu = time.process_time()
+        try:
+            yield counters
+        finally:
+            wall = time.perf_counter() - wall
+            cpu = time.process_time() - cpu
+            if profile is not None:
+                profile.disable()
+            thread.name = thread_name
+            self.add(name, wall, cpu, **counters)
+
+    def add(self, name, wall, cpu, calls=1, **counters):
+        peak_rss_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+        with self.lock:
+            entry = self.stages.setdefault(name, {"calls": 0, "wall": 0.0, "cpu": 0.0, "peak_rss_mb": 0.0})
+            entry["calls"] += calls
+            entry["wall"] += wall
+            entry["cpu"] += cpu
+            entry["peak_rss_mb"] = max(entry["peak_rss_mb"], peak_rss_mb)
+            for key, value in counters.items():
+                entry[key] = entry.get(key, 0) + value
+
+    def _profile(self, name):
+        if self.profile_dir is None or name not in self.profile_stages:
+            return None
+        with self.lock:
+            profile = self.profiles.setdefault(name, cProfile.Profile())
+        try:
+            profile.enable()
+        except ValueError:
+            # Another profiler is already running in this thread (a nested profiled stage)
+            return None
+        return profile
+
+    def dump_profiles(self):
+        if not self.profiles:
+            return []
+        os.makedirs(self.profile_dir, exist_ok=True)
+
+        written = []
+        for name, profile in self.profiles.items():
+            path = os.path.join(self.profile_dir, f"{self.document_name}_{name}.prof")
+            profile.dump_stats(path)
+            written.append(path)
+        return written
+
+    def report(self):
+        with self.lock:
+            return summarize({name: dict(entry) for name, entry in self.stages.items()})
+
+# Adds the rates to the raw per-stage totals, stages come back in pipeline order with their sub-stages after them
+def summarize(stages):
+    order = {stage: i for i, stage in enumerate(STAGES)}
+    stages = {name: stages[name] for name in sorted(stages, key=lambda name: (order.get(name.split(".")[0], len(order)), name))}
+    for entry in stages.values():
+        if entry.get("pages"):
+            entry["pages_per_second"] = entry["pages"] / entry["wall"] if entry["wall"] else 0.0
+            if "boxes" in entry:
+                entry["boxes_per_page"] = entry["boxes"] / entry["pages"]
+    return stages
+
+# Totals of the per-document reports of a whole run, the peak RSS is the highest any worker reached
+def aggregate(reports):
+    stages = {}
+    for report in reports:
+        for name, entry in report.items():
+            total = stages.setdefault(name, {"documents": 0, "calls": 0, "wall": 0.0, "cpu": 0.0, "peak_rss_mb": 0.0})
+            total["documents"] += 1
+            for key, value in entry.items():
+                if key == "peak_rss_mb":
+                    total[key] = max(total[key], value)
+                elif key not in ("pages_per_second", "boxes_per_page"):
+                    total[key] = total.get(key, 0) + value
+    return summarize(stages)
+
+profiler = StageProfiler()
@@ -0,0 +1,142 @@
+import os
+import math
+import tempfile
+import threading
+import numpy as np
+from PIL import Image
+
+# Whole page images the layout model already rendered, so crops that do not need more than the layout DPI
+# are cut out of them instead of rendering the page a second time.
+# policies map a route to the DPIPolicy of the extractor that crops its boxes, a page is only kept when at least
+# one of its boxes would be cropped at no more than the page's DPI (see keeps), the rest would never be served.
+# Text boxes only count on empty_pages (no text layer), where every text region goes to the VLM.
+# Up to max_bytes of pages stay in memory, the rest spill to a memory-mapped file in spill_dir (removed on close).
+class PageRasters:
+    # Rounding of the rendered size leaves the layout DPI a hair under what it was asked for
+    DPI_TOLERANCE = 0.99
+
+    def __init__(self, max_bytes=256 * 1024 * 1024, spill_dir=None, policies=None):
+        self.max_bytes = max_bytes
+        self.spill_dir = spill_dir
+        self.policies = dict(policies or {})
+        self.empty_pages = set()
+        self.lock = threading.Lock()
+        # page_idx -> (array, dpi, bgr)
+        self.pages = {}
+        self.memory_bytes = 0
+        self.spill_path = None
+        self.spill_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.skipped = 0
+
+    def __len__(self):
+        return len(self.pages)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    # True when one of the (route, box) pairs of a page would be cut from a raster at dpi
+    def keeps(self, page_idx, routed_boxes, dpi):
+        for route, box in routed_boxes:
+            if route == "text" and page_idx not in self.empty_pages:
+                continue
+            policy = self.policies.get(route)
+            if policy is not None and self.serves(policy.dpi(box), dpi):
+                return True
+        return False
+
+    @classmethod
+    def serves(cls, dpi, raster_dpi):
+        return raster_dpi >= dpi * cls.DPI_TOLERANCE
+
+    # bgr=True keeps a BGR image (what paddle works on) as it is, the channels are only swapped in the crops.
+    # In memory the image is kept by reference, not copied.
+    def put(self, page_idx, image, dpi, bgr=False):
+        with self.lock:
+            if self.memory_bytes + image.nbytes <= self.max_bytes:
+                self.memory_bytes += image.nbytes
+            else:
+                image = self._spill(image)
+            self.pages[page_idx] = (image, dpi, bgr)
+
+    def _spill(self, image):
+        if self.spill_path is None:
+            fd, self.spill_path = tempfile.mkstemp(suffix=".rasters", dir=self.spill_dir)
+            os.close(fd)
+
+        offset = self.spill_bytes
+        with open(self.spill_path, "ab") as f:
+            f.write(np.ascontiguousarray(image).tobytes())
+        self.spill_bytes += image.nbytes
+        return np.memmap(self.spill_path, dtype=np.uint8, mode="r", offset=offset, shape=image.shape)
+
+    # (image, dpi, bgr) of a page if it was rendered at no less than dpi, None otherwise
+    def get(self, page_idx, dpi):
+        with self.lock:
+            image, raster_dpi, bgr = self.pages.get(page_idx, (None, 0, False))
+            if image is None or not self.serves(dpi, raster_dpi):
+                self.misses += 1
+                return None
+            self.hits += 1
+            return image, raster_dpi, bgr
+
+    # The region bbox (PDF points) of a page at dpi, the same size render_clip gives.
+    # A view of the raster when the DPI matches, a downscaled copy when less is asked for, None when not cached.
+    def cut(self, page_idx, bbox, dpi):
+        cached = self.get(page_idx, dpi)
+        if cached is None:
+            return None
+        image, raster_dpi, bgr = cached
+        height, width = image.shape[:2]
+
+        # Pixel rect of the clip at the asked DPI, rounded outwards like PyMuPDF does
+        zoom = dpi / 72
+        x0, y0, x1, y1 = bbox
+        out_w = max(math.ceil(x1 * zoom) - math.floor(x0 * zoom), 1)
+        out_h = max(math.ceil(y1 * zoom) - math.floor(y0 * zoom), 1)
+
+        scale = raster_dpi / 72
+        left, top = max(x0 * scale, 0), max(y0 * scale, 0)
+        right, bottom = min(x1 * scale, width), min(y1 * scale, height)
+        if right <= left or bottom <= top:
+            return None
+
+        region = image[int(top):math.ceil(bottom), int(left):math.ceil(right)]
+        if bgr:
+            region = region[..., ::-1]
+        if region.shape[1] == out_w and region.shape[0] == out_h:
+            return region
+
+        resized = Image.fromarray(np.ascontiguousarray(region)).resize(
+            (out_w, out_h), Image.LANCZOS,
+            box=(left - int(left), top - int(top), right - int(left), bottom - int(top))
+        )
+        return np.asarray(resized)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "pages": len(self.pages),
+            "skipped_pages": self.skipped,
+            "memory_bytes": self.memory_bytes,
+            "spill_bytes": self.spill_bytes
+        }
+
+    def close(self):
+        with self.lock:
+            self.pages.clear()
+            self.memory_bytes = 0
+            if self.spill_path is not None:
+                try:
+                    os.remove(self.spill_path)
+                except FileNotFoundError:
+                    pass
+                self.spill_path = None
+            self.spill_bytes = 0
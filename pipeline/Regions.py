@@ -0,0 +1,26 @@
+import hashlib
+
+# Remembers the first occurrence of every region of a document by label, position and content, so a header,
+# footer or stamp that comes back on every page is recognised as the same region.
+# Positions are compared on a grid of grid points, the content is any text or pixel bytes.
+class RegionIndex:
+    def __init__(self, grid=2.0):
+        self.grid = grid
+        self.first = {}
+
+    def fingerprint(self, box, content):
+        if isinstance(content, str):
+            content = content.encode("utf-8")
+        position = tuple(round(v / self.grid) for v in box["pdf_bbox"])
+        return box["label"], position, hashlib.sha1(content).hexdigest()
+
+    # (page_idx, order) of an earlier region with the same fingerprint, None (and the region is remembered) otherwise
+    def seen(self, box, page_idx, content):
+        key = self.fingerprint(box, content)
+        if key in self.first:
+            return self.first[key]
+        self.first[key] = (page_idx, box["order"])
+        return None
+
+    def __len__(self):
+        return len(self.first)
@@ -0,0 +1,228 @@
+import os
+import json
+import glob
+import time
+import traceback
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from Profiler import aggregate
+
+# Per-process pipeline, built once by the pool initializer so models load once per worker
+_pipeline = None
+
+def _init_worker(pipeline_options):
+    global _pipeline
+    from Pipeline import Pipeline
+    _pipeline = Pipeline(**pipeline_options)
+
+def _run_document(input_path):
+    start = time.perf_counter()
+    try:
+        return _pipeline.run(input_path)
+    except Exception:
+        return {
+            "input_path": input_path,
+            "status": "failed",
+            "error": traceback.format_exc(),
+            "seconds": time.perf_counter() - start
+        }
+
+# One page range of a document, merged by _merge_document once every range of it is done
+def _run_shard(input_path, start, stop):
+    started = time.time()
+    begin = time.perf_counter()
+    try:
+        return _pipeline.run_shard(input_path, start, stop)
+    except Exception:
+        return {
+            "input_path": input_path,
+            "status": "failed",
+            "start": start,
+            "stop": stop,
+            "error": traceback.format_exc(),
+            "started": started,
+            "seconds": time.perf_counter() - begin
+        }
+
+def _merge_document(input_path, shards):
+    begin = time.perf_counter()
+    try:
+        failed = _failed_shard(shards)
+        if failed is not None:
+            _pipeline.discard_shards(input_path, shards)
+            return failed
+        return _pipeline.merge_shards(input_path, shards)
+    except Exception:
+        return {
+            "input_path": input_path,
+            "status": "failed",
+            "error": traceback.format_exc(),
+            "seconds": time.perf_counter() - begin
+        }
+
+# A document fails as a whole when one of its shards does
+def _failed_shard(shards):
+    failed = [shard for shard in shards if shard["status"] == "failed"]
+    if not failed:
+        return None
+    return {
+        "input_path": failed[0]["input_path"],
+        "status": "failed",
+        "error": f"pages {failed[0]['start']}-{failed[0]['stop'] - 1}:\n{failed[0]['error']}",
+        "seconds": time.time() - min(shard["started"] for shard in shards)
+    }
+
+def page_count(input_path):
+    import fitz
+    with fitz.open(input_path) as doc:
+        return doc.page_count
+
+# Accepts PDF files, directories (searched recursively), glob patterns and manifests (one path per line)
+def collect_inputs(sources):
+    input_paths = []
+    for source in sources:
+        if os.path.isdir(source):
+            found = glob.glob(os.path.join(source, "**", "*.pdf"), recursive=True)
+            input_paths.extend(sorted(found))
+        elif os.path.isfile(source) and not source.lower().endswith(".pdf"):
+            base = os.path.dirname(source)
+            with open(source, encoding="utf-8") as f:
+                for line in f:
+                    line = line.strip()
+                    if line and not line.startswith("#"):
+                        input_paths.append(os.path.join(base, line))
+        elif os.path.isfile(source):
+            input_paths.append(source)
+        else:
+            input_paths.extend(sorted(glob.glob(source, recursive=True)))
+
+    # Keep the first occurrence of each document
+    return list(dict.fromkeys(input_paths))
+
+# Every output file (JSON, manifest, profile, images) is named after the PDF's file name without its directory,
+# documents that share one would overwrite each other's output. Returns {name: [paths]} of the clashes.
+def duplicate_names(input_paths):
+    names = {}
+    for input_path in input_paths:
+        names.setdefault(os.path.splitext(os.path.basename(input_path))[0], []).append(input_path)
+    return {name: paths for name, paths in names.items() if len(paths) > 1}
+
+# shard_pages: documents with more pages than this are split into page ranges of that size, which run on any worker
+# like documents do and are merged back into one document's output. Not with dedupe (regions are matched across
+# pages) or resume and rerun (shards do not read the manifest).
+class DocumentScheduler:
+    def __init__(self, workers=1, shard_pages=None, **pipeline_options):
+        self.workers = max(1, workers)
+        self.shard_pages = shard_pages
+        self.pipeline_options = pipeline_options
+        self.results = []
+        self.elapsed = 0.0
+
+    def run(self, input_paths):
+        duplicates = duplicate_names(input_paths)
+        if duplicates:
+            raise ValueError("Documents with the same file name would overwrite each other's output: " + "; ".join(", ".join(paths) for paths in duplicates.values()))
+
+        self.results = []
+        start = time.perf_counter()
+
+        for result in self._results(input_paths):
+            self.results.append(result)
+            print(f"[{len(self.results)}/{len(input_paths)}] {result['status']:>7} {result['seconds']:8.2f}s {result['input_path']}")
+            if result["status"] == "failed":
+                print(result["error"])
+
+        self.elapsed = time.perf_counter() - start
+        self.report()
+        return self.results
+
+    # [start, stop) page ranges of a document, None when it runs whole
+    def shards(self, input_path):
+        if not self.shard_pages or self.pipeline_options.get("dedupe") or self.pipeline_options.get("resume") or self.pipeline_options.get("rerun"):
+            return None
+        try:
+            pages = page_count(input_path)
+        except Exception:
+            # Unreadable, it runs whole so _run_document reports it as one failed document
+            return None
+        if pages <= self.shard_pages:
+            return None
+        return [(start, min(start + self.shard_pages, pages)) for start in range(0, pages, self.shard_pages)]
+
+    def _results(self, input_paths):
+        tasks = [(input_path, self.shards(input_path)) for input_path in input_paths]
+        units = sum(len(ranges) if ranges else 1 for _, ranges in tasks)
+
+        # A single worker runs in this process, handy for debugging
+        if self.workers == 1 or units <= 1:
+            _init_worker(self.pipeline_options)
+            for input_path, ranges in tasks:
+                if ranges is None:
+                    yield _run_document(input_path)
+                    continue
+                shards = [_run_shard(input_path, start, stop) for start, stop in ranges]
+                yield _merge_document(input_path, shards)
+            return
+
+        # Spawn, not fork, paddle and torch are not fork safe once initialized
+        ctx = mp.get_context("spawn")
+        workers = min(self.workers, units)
+        with ProcessPoolExecutor(workers, mp_context=ctx, initializer=_init_worker, initargs=(self.pipeline_options,)) as pool:
+            # Workers pull one document or shard at a time, a document's merge is queued once its last shard is in
+            pending = set()
+            shards = {}
+            remaining = {}
+            for input_path, ranges in tasks:
+                if ranges is None:
+                    pending.add(pool.submit(_run_document, input_path))
+                    continue
+                shards[input_path] = []
+                remaining[input_path] = len(ranges)
+                for start, stop in ranges:
+                    pending.add(pool.submit(_run_shard, input_path, start, stop))
+
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    result = future.result()
+                    if "start" not in result:
+                        yield result
+                        continue
+
+                    input_path = result["input_path"]
+                    shards[input_path].append(result)
+                    remaining[input_path] -= 1
+                    if remaining[input_path] == 0:
+                        pending.add(pool.submit(_merge_document, input_path, shards.pop(input_path)))
+
+    def report(self):
+        done = [r for r in self.results if r["status"] != "failed"]
+        failed = len(self.results) - len(done)
+        minutes = self.elapsed / 60
+
+        print(f"{len(done)} documents processed, {failed} failed in {self.elapsed:.2f}s")
+        if minutes > 0:
+            print(f"Throughput: {len(done) / minutes:.2f} docs/min with {self.workers} worker(s)")
+
+        stages = aggregate(r["profile"] for r in done if "profile" in r)
+        if stages:
+            self.report_stages(stages)
+
+    # Where the time went over the whole run, the stage with the most wall time is the one to scale out
+    def report_stages(self, stages):
+        print(f"{'stage':>20} {'wall s':>8} {'cpu s':>8} {'pages/s':>8} {'boxes/page':>10} {'Mpixels':>8} {'peak RSS MB':>12}")
+        for name, entry in stages.items():
+            print(
+                f"{name:>20} {entry['wall']:>8.2f} {entry['cpu']:>8.2f} {entry.get('pages_per_second', 0):>8.1f} "
+                f"{entry.get('boxes_per_page', 0):>10.1f} {entry.get('pixels', 0) / 1e6:>8.1f} {entry['peak_rss_mb']:>12.0f}"
+            )
+
+        output_path = self.pipeline_options.get("output_path", "output")
+        os.makedirs(output_path, exist_ok=True)
+        with open(os.path.join(output_path, "run_profile.json"), "w", encoding="utf-8") as f:
+            json.dump({
+                "documents": len(self.results),
+                "workers": self.workers,
+                "seconds": self.elapsed,
+                "stages": stages
+            }, f, ensure_ascii=False, indent=4)
@@ -1,181 +1,532 @@
+import io
 import os
 import re
 import json
 import math
+import time
+import heapq
 import tempfile
-import torch
-import fitz # PyMuPDF
+import multiprocessing as mp
+import numpy as np
 from PIL import Image
 from PostProcess import PostProcess
-from paddleocr import FormulaRecognition
-from transformers import AutoModel, AutoTokenizer
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from Document import open_document, render_clips
+from Geometry import intersection_over_a, areas, pack_shelves
+from Models import registry
+from Profiler import profiler
+from Regions import RegionIndex
+from Tables import NativeTables
+
+# Decides the render DPI of every crop: a per-label DPI, lowered so the longest side is not much bigger
+# than what the consuming model resizes to (target_size), and a hard cap on the pixel count (max_pixels)
+class DPIPolicy:
+    def __init__(self, default_dpi=250, label_dpi=None, target_size=None, max_pixels=None, min_dpi=72):
+        self.default_dpi = default_dpi
+        self.label_dpi = label_dpi or {}
+        self.target_size = target_size
+        self.max_pixels = max_pixels
+        self.min_dpi = min_dpi
+
+    def dpi(self, box):
+        x0, y0, x1, y1 = box["pdf_bbox"]
+        width, height = max(x1 - x0, 1e-6), max(y1 - y0, 1e-6)
+
+        dpi = self.label_dpi.get(box["label"], self.default_dpi)
+
+        # Never render more than the model is going to look at. The clip is rounded outwards to whole pixels, which
+        # adds up to one more, so the long side is aimed one pixel short of target_size to come out at most that.
+        if self.target_size is not None:
+            dpi = min(dpi, (self.target_size - 1) * 72 / max(width, height))
+        dpi = max(dpi, self.min_dpi)
+
+        # The pixel cap wins over min_dpi
+        if self.max_pixels is not None:
+            dpi = min(dpi, 72 * math.sqrt(self.max_pixels / (width * height)))
+
+        return dpi
+
+    # Pixel count of a box rendered at this policy's DPI
+    def pixels(self, box):
+        x0, y0, x1, y1 = box["pdf_bbox"]
+        zoom = self.dpi(box) / 72
+        return int((x1 - x0) * zoom + 1) * int((y1 - y0) * zoom + 1)
+
+# A crop dict whose PIL "image" is only built (and copied) from the "array" view the first time it is asked for
+class Crop(dict):
+    def __missing__(self, key):
+        if key == "image" and "array" in self:
+            self["image"] = Image.fromarray(self["array"])
+            return self["image"]
+        raise KeyError(key)
+
+# Render processes for the crops, one pool per process shared by every extractor and kept across documents
+# (spawning one costs more than rendering the crops of a small document). A different worker count replaces it.
+_render_pool = None
+
+def render_pool(workers):
+    global _render_pool
+    if _render_pool is not None and _render_pool[0] != workers:
+        _render_pool[1].shutdown()
+        _render_pool = None
+    if _render_pool is None:
+        pool = ProcessPoolExecutor(workers, mp_context=mp.get_context("spawn"))
+        # A scheduler worker waits for its child processes on exit, shut the pool down first. Before the finalizers of
+        # the pool's own queues (priority 10) run, they would close the queue the stop messages go through.
+        mp.util.Finalize(None, pool.shutdown, exitpriority=100)
+        _render_pool = (workers, pool)
+    return _render_pool[1]
 
 class SectionCrop:
+    # Same 250 DPI for every crop unless an extractor passes its own policy
+    DEFAULT_POLICY = DPIPolicy()
+    MAX_INFLIGHT_BYTES = 512 * 1024 * 1024
+
+    # output="pil" gives a PIL "image" per crop, output="array" an RGB (height, width, 3) "array" that views
+    # the rendered pixels without copying them (the PIL image is then built lazily)
+    @staticmethod
+    def crop(coordinates, document=None, workers=0, policy=None, output="pil", pages_per_task=4, max_inflight_bytes=MAX_INFLIGHT_BYTES):
+        return list(SectionCrop.iter_crops(coordinates, document, workers, policy, output, pages_per_task, max_inflight_bytes))
+
+    # The crops in (page_idx, order) order as they are ready, so a consumer starts on the first ones while the
+    # workers render the rest. With workers at most max_inflight_bytes of rendered pixels wait to be taken.
     @staticmethod
-    def crop(coordinates):
+    def iter_crops(coordinates, document=None, workers=0, policy=None, output="pil", pages_per_task=4, max_inflight_bytes=MAX_INFLIGHT_BYTES):
         if not coordinates:
-            return []
+            return
+        policy = policy or SectionCrop.DEFAULT_POLICY
+
+        # Worker processes open their own copy of the PDF, they only get the boxes the page rasters cannot serve
+        if workers > 0:
+            rasters = getattr(document, "rasters", None)
+            cropped, coordinates = SectionCrop._crop_rasters(coordinates, rasters, policy, output)
+            cropped.sort(key=lambda c: (c["page_idx"], c["order"]))
+            rendered = SectionCrop.crop_parallel(coordinates, workers, pages_per_task, max_inflight_bytes, policy, output)
+            yield from heapq.merge(cropped, rendered, key=lambda c: (c["page_idx"], c["order"]))
+            return
 
-        input_path = coordinates[0]["input_path"]
-        doc = fitz.open(input_path)
+        with open_document(document or coordinates[0]["input_path"]) as doc:
+            cropped = SectionCrop._crop(coordinates, doc, policy, output)
+        yield from cropped
 
-        dpi = 250
-        zoom = dpi / 72
-        mat = fitz.Matrix(zoom, zoom)
+    # Crops of different sizes copied once into a single (n, max_height, max_width, 3) block, padded with white.
+    # Each crop's "array" becomes a view of its own slice of the block.
+    @staticmethod
+    def crop_batch(coordinates, document=None, policy=None, pad_value=255):
+        cropped = SectionCrop.crop(coordinates, document, policy=policy, output="array")
+        if not cropped:
+            return None, []
 
-        cropped_images = []
-        for page_data in coordinates:
-            page_idx = page_data["page_idx"]
-            if page_idx >= len(doc):
-                continue
+        height = max(c["array"].shape[0] for c in cropped)
+        width = max(c["array"].shape[1] for c in cropped)
+        batch = np.full((len(cropped), height, width, 3), pad_value, dtype=np.uint8)
 
-            page = doc[page_idx]
+        for i, crop_data in enumerate(cropped):
+            h, w = crop_data["array"].shape[:2]
+            batch[i, :h, :w] = crop_data["array"]
+            crop_data["array"] = batch[i, :h, :w]
+            # The pixels now live in the batch, the pixmap can go
+            crop_data.pop("pixmap", None)
 
-            for box in page_data["boxes"]:
-                x0, y0, x1, y1 = box["pdf_bbox"]
-                clip = fitz.Rect(x0, y0, x1, y1)
+        return batch, cropped
+
+    @staticmethod
+    def _make_crop(page_idx, order, label, width, height, samples, output, pixmap=None):
+        crop_data = Crop(page_idx=page_idx, order=order, label=label)
+        if output == "array":
+            crop_data["array"] = np.frombuffer(samples, dtype=np.uint8).reshape(height, width, 3)
+            # The array is a view of the pixmap's buffer, keep the pixmap alive with it
+            if pixmap is not None:
+                crop_data["pixmap"] = pixmap
+        else:
+            crop_data["image"] = Image.frombytes("RGB", [width, height], samples)
+        return crop_data
+
+    # A crop cut out of a page raster, the array may be a view of it
+    @staticmethod
+    def _make_array_crop(page_idx, order, label, array, output):
+        crop_data = Crop(page_idx=page_idx, order=order, label=label)
+        if output == "array":
+            crop_data["array"] = array
+        else:
+            crop_data["image"] = Image.fromarray(np.ascontiguousarray(array))
+        return crop_data
 
-                pix = page.get_pixmap(matrix=mat, clip=clip)
-                img = Image.frombytes("RGB", [pix.width, pix.height], pix.samples)
+    # Crops the page rasters can serve, and the coordinates (pages with the boxes left) that still need rendering
+    @staticmethod
+    def _crop_rasters(coordinates, rasters, policy, output="pil"):
+        if rasters is None:
+            return [], coordinates
 
-                cropped_images.append({
-                    "page_idx": page_idx,
-                    "order": box["order"],
-                    "label": box["label"],
-                    "image": img
-                })
+        cropped_images = []
+        remaining = []
+        with profiler.stage("crop.rasters", boxes=0, pixels=0) as counters:
+            for page_data in coordinates:
+                boxes = []
+                for box in page_data["boxes"]:
+                    array = rasters.cut(page_data["page_idx"], box["pdf_bbox"], policy.dpi(box))
+                    if array is None:
+                        boxes.append(box)
+                        continue
+
+                    cropped_images.append(SectionCrop._make_array_crop(page_data["page_idx"], box["order"], box["label"], array, output))
+                    counters["boxes"] += 1
+                    counters["pixels"] += array.shape[0] * array.shape[1]
+                if boxes:
+                    remaining.append({**page_data, "boxes": boxes})
+
+        return cropped_images, remaining
+
+    @staticmethod
+    def _crop(coordinates, doc, policy, output="pil"):
+        rasters = getattr(doc, "rasters", None)
+        cropped_images = []
+        with profiler.stage("crop", boxes=0, pixels=0) as counters:
+            for page_data in coordinates:
+                page_idx = page_data["page_idx"]
+                if page_idx >= len(doc):
+                    continue
+
+                for box in page_data["boxes"]:
+                    # Cut from the layout stage's page image when it was rendered at a high enough DPI
+                    array = rasters.cut(page_idx, box["pdf_bbox"], policy.dpi(box)) if rasters is not None else None
+                    if array is not None:
+                        cropped_images.append(SectionCrop._make_array_crop(page_idx, box["order"], box["label"], array, output))
+                        counters["boxes"] += 1
+                        counters["pixels"] += array.shape[0] * array.shape[1]
+                        continue
+
+                    pix = doc.render_clip(page_idx, box["pdf_bbox"], policy.dpi(box))
+                    samples = pix.samples_mv if output == "array" else pix.samples
+
+                    cropped_images.append(SectionCrop._make_crop(
+                        page_idx, box["order"], box["label"], pix.width, pix.height, samples, output, pix
+                    ))
+                    counters["boxes"] += 1
+                    counters["pixels"] += pix.width * pix.height
 
-        doc.close()
         return cropped_images
 
+    # Renders groups of pages in a process pool and yields crops in (page_idx, order) order as soon as they are ready.
+    # At most max_inflight_bytes of rendered pixels are pending at once (always at least one group).
     @staticmethod
-    def save_images(cropped_images, output_path, pdf_name):
+    def crop_parallel(coordinates, workers=4, pages_per_task=4, max_inflight_bytes=MAX_INFLIGHT_BYTES, policy=None, output="pil"):
+        if not coordinates:
+            return
+
+        input_path = coordinates[0]["input_path"]
+        policy = policy or SectionCrop.DEFAULT_POLICY
+
+        with open_document(input_path) as doc:
+            page_count = len(doc)
+
+        pages = sorted((p for p in coordinates if p["page_idx"] < page_count), key=lambda p: p["page_idx"])
+        groups = []
+        for start in range(0, len(pages), pages_per_task):
+            jobs = []
+            size = 0
+            for page_data in pages[start:start + pages_per_task]:
+                for box in sorted(page_data["boxes"], key=lambda b: b["order"]):
+                    jobs.append((page_data["page_idx"], box["order"], box["label"], box["pdf_bbox"], policy.dpi(box)))
+                    # Estimated RGB bytes once rendered
+                    size += policy.pixels(box) * 3
+
+            groups.append((jobs, size))
+
+        pool = render_pool(workers)
+        pending = deque()
+        inflight = 0
+        next_group = 0
+        try:
+            while next_group < len(groups) or pending:
+                while next_group < len(groups) and (not pending or inflight + groups[next_group][1] <= max_inflight_bytes):
+                    jobs, size = groups[next_group]
+                    pending.append((pool.submit(render_clips, input_path, jobs), size))
+                    inflight += size
+                    next_group += 1
+
+                future, size = pending.popleft()
+                # Only the time spent waiting on the workers, they render in parallel
+                with profiler.stage("crop", boxes=0, pixels=0) as counters:
+                    rendered = future.result()
+                    counters["boxes"] = len(rendered)
+                    counters["pixels"] = sum(r[3] * r[4] for r in rendered)
+                # The group's bytes count until its crops are taken, a slow consumer holds the next groups back
+                for page_idx, order, label, width, height, samples in rendered:
+                    yield SectionCrop._make_crop(page_idx, order, label, width, height, samples, output)
+                inflight -= size
+        finally:
+            # A consumer that stops early leaves nothing running on the shared pool
+            for future, _ in pending:
+                future.cancel()
+
+    # Debug images of the crops as <name>_p<page>_o<order>_<label>.png. With a debug output only the pages it samples
+    # are written, by its writer thread (the PNG is encoded there too). Returns the paths written or queued.
+    @staticmethod
+    def save_images(cropped_images, output_path, pdf_name, debug=None):
         os.makedirs(output_path, exist_ok=True)
-        for i, crop_data in enumerate(cropped_images, start=1):
-            label = crop_data["label"]
-            image = crop_data["image"]
-            
-            filename = f"{pdf_name}_{label}_{i}.png"
+        written = []
+        for crop_data in cropped_images:
+            page_idx = crop_data["page_idx"]
+            if debug is not None and not debug.page(page_idx):
+                continue
+
+            filename = f"{pdf_name}_p{page_idx}_o{crop_data['order']}_{crop_data['label']}.png"
             image_path = os.path.join(output_path, filename)
-            image.save(image_path)
+            if debug is None:
+                SectionCrop.save_image(crop_data, image_path)
+            else:
+                debug.write(SectionCrop.save_image, crop_data, image_path)
+            written.append(image_path)
+        return written
+
+    @staticmethod
+    def save_image(crop_data, image_path):
+        crop_data["image"].save(image_path)
 
 
 class MathExtract:
-    def __init__(self, model="PP-FormulaNet_plus-L"):
-        self.model = FormulaRecognition(model_name=model)
+    # Upper bounds of the width/height buckets, wider crops all share the last one
+    ASPECT_BUCKETS = (1, 2, 4, 8, 16)
+
+    # PP-FormulaNet resizes its input to 768x768, larger crops only cost render time
+    def __init__(self, model="PP-FormulaNet_plus-L", crop_workers=0, dpi_policy=None, batch_size=16, crop_inflight_bytes=SectionCrop.MAX_INFLIGHT_BYTES):
+        self.model_name = model
+        self.crop_workers = crop_workers
+        self.crop_inflight_bytes = crop_inflight_bytes
+        self.dpi_policy = dpi_policy or DPIPolicy(target_size=768)
+        self.batch_size = batch_size
         self.results = None
+        self.timings = None
+        self.input_path = None
+
+    # Loaded on the first formula, not when the pipeline is built
+    @property
+    def model(self):
+        return registry.get("formula", self.model_name)
 
-    def extract(self, math_coordinates):
-        cropped = SectionCrop.crop(math_coordinates)
-        images = [c["image"] for c in cropped]
-        output = self.model.predict(input=images, batch_size=1)
-        self.results = output
-        return output
+    # Crops with a similar shape and size go in the same batch, so little of a batch is padding
+    def bucket(self, array):
+        h, w = array.shape[:2]
+        aspect = w / max(h, 1)
+        aspect_bucket = next((i for i, bound in enumerate(self.ASPECT_BUCKETS) if aspect <= bound), len(self.ASPECT_BUCKETS))
+        size_bucket = int(math.log2(max(h * w, 1))) // 2
+        return aspect_bucket, size_bucket
+
+    def extract(self, math_coordinates, document=None):
+        self.results = None
+        self.timings = None
+        if not math_coordinates:
+            return []
+        self.input_path = math_coordinates[0]["input_path"]
+
+        cropped = SectionCrop.iter_crops(
+            math_coordinates, document, self.crop_workers, self.dpi_policy, output="array", max_inflight_bytes=self.crop_inflight_bytes
+        )
+
+        # A bucket's batch is predicted as soon as it is full, while the crop workers render the next pages.
+        # The partly filled ones go last, in bucket order.
+        buckets = {}
+        formulas = {}
+        timings = []
+        for crop_data in cropped:
+            bucket = self.bucket(crop_data["array"])
+            batch = buckets.setdefault(bucket, [])
+            batch.append(crop_data)
+            if len(batch) == self.batch_size:
+                self.predict(bucket, batch, formulas, timings)
+                buckets[bucket] = []
+        for bucket, batch in sorted(buckets.items()):
+            if batch:
+                self.predict(bucket, batch, formulas, timings)
+
+        # Scatter the formulas back onto the boxes they came from
+        results = []
+        for page_data in math_coordinates:
+            page_idx = page_data["page_idx"]
+            boxes = []
+            for box in page_data["boxes"]:
+                region = box.copy()
+                region["latex"] = formulas.get((page_idx, box["order"]), "")
+                boxes.append(region)
+            results.append({**page_data, "boxes": boxes})
+
+        self.results = results
+        self.timings = timings
+        return results
+
+    # One batch of crops through the model, the formulas go into formulas by (page_idx, order)
+    def predict(self, bucket, batch, formulas, timings):
+        # Paddle reads arrays as BGR, the reversed channels are still a view of the pixmap
+        images = [c["array"][..., ::-1] for c in batch]
+
+        batch_start = time.perf_counter()
+        with profiler.stage("math.predict", boxes=len(images)):
+            output = self.model.predict(input=images, batch_size=len(images))
+        timings.append({
+            "bucket": list(bucket),
+            "batch_size": len(images),
+            "seconds": time.perf_counter() - batch_start
+        })
+
+        for crop_data, res in zip(batch, output):
+            formulas[(crop_data["page_idx"], crop_data["order"])] = res["rec_formula"]
 
     def save_results(self, output_path):
-        pass
+        if not self.results:
+            return []
+
+        os.makedirs(output_path, exist_ok=True)
+
+        pdf_name = os.path.splitext(os.path.basename(self.input_path))[0]
+
+        json_path = os.path.join(output_path, f"{pdf_name}_math_results.json")
+        with open(json_path, "w", encoding="utf-8") as f:
+            json.dump(self.results, f, ensure_ascii=False, indent=4)
+
+        timing_path = os.path.join(output_path, f"{pdf_name}_math_timing.json")
+        with open(timing_path, "w", encoding="utf-8") as f:
+            json.dump({
+                "crops": sum(t["batch_size"] for t in self.timings),
+                "batches": len(self.timings),
+                "seconds": sum(t["seconds"] for t in self.timings),
+                "per_batch": self.timings
+            }, f, ensure_ascii=False, indent=4)
+
+        return [json_path, timing_path]
 
 class TextExtract:
-    def __init__(self):
+    # dedupe: a region with the same label, position and text as one on an earlier page (running headers, footers,
+    # stamps) keeps no text of its own, it gets "duplicate_of": [page_idx, order] of the first one instead
+    def __init__(self, dedupe=False):
         self.extracted_text = None
         self.empty_regions = None
         self.input_path = None
+        self.dedupe = dedupe
         self.post_processor = PostProcess()
+        self.reset()
+
+    # Per document state, extract() calls it, callers driving extract_page themselves call it before each document
+    def reset(self):
+        self.extracted_text = None
+        self.empty_regions = None
+        self.regions = RegionIndex()
+        # Raw text -> normalized text, repeated regions are only normalized once
+        self.processed = {}
 
     def map_words_to_boxes(self, page, layout_boxes):
         all_words = page.get_text("words")
-        
+        return self.assign_words(all_words, layout_boxes)
+
+    @staticmethod
+    def assign_words(all_words, layout_boxes):
         box_contents = {i: [] for i in range(len(layout_boxes))}
+        if not all_words or not layout_boxes:
+            return box_contents
 
-        for word in all_words:
-            wx0, wt, wx1, wb, text = word[0], word[1], word[2], word[3], word[4]
-            
-            word_area = (wx1 - wx0) * (wb - wt) + 1e-9
-            
-            candidates = []
-            for idx, box in enumerate(layout_boxes):
-                bx0, bt, bx1, bb = box["pdf_bbox"]
-                
-                ix0 = max(wx0, bx0)
-                it  = max(wt, bt)
-                ix1 = min(wx1, bx1)
-                ib  = min(wb, bb)
-                
-                if ix1 > ix0 and ib > it:
-                    inter_area = (ix1 - ix0) * (ib - it)
-                    iow_score = inter_area / word_area
-                    box_area = (bx1 - bx0) * (bb - bt)
-                    candidates.append({
-                        "idx": idx,
-                        "iow": iow_score,
-                        "area": box_area
-                    })
-            
-            if candidates:
-                best_box = sorted(candidates, key=lambda x: (-x["iow"], x["area"]))[0]
-                box_contents[best_box["idx"]].append(text)
+        # (n_words, 1) against (1, n_boxes), every word is scored against every box in one pass
+        boxes = [box["pdf_bbox"] for box in layout_boxes]
+        hit, iow = intersection_over_a([word[:4] for word in all_words], boxes)
+        box_area = areas(boxes)
+
+        # Highest IoW wins, ties go to the smallest box, then to the first box (same as the stable sort)
+        best_iow = iow.max(axis=1, keepdims=True)
+        tied_area = np.where(hit & (iow == best_iow), box_area, np.inf)
+        best_idx = tied_area.argmin(axis=1)
+
+        for word_idx in np.flatnonzero(hit.any(axis=1)):
+            box_contents[int(best_idx[word_idx])].append(all_words[word_idx][4])
 
         return box_contents
 
-    def extract(self, layout_results):
-        final_output = []
-        empty_output = []
+    # no_text_pages are pages known to have no text layer (scanned), every box on them comes back empty
+    def extract(self, layout_results, document=None, no_text_pages=()):
+        # Reset so a reused extractor never saves the previous document's results
+        self.reset()
         if not layout_results:
             return [], []
+
+        with open_document(document or layout_results[0]["input_path"]) as doc:
+            return self._extract(layout_results, doc, no_text_pages)
+
+    def _extract(self, layout_results, doc, no_text_pages=()):
+        final_output = []
+        empty_output = []
             
         self.input_path = layout_results[0]["input_path"]
         
-        doc = fitz.open(self.input_path)
-        
         for page_data in layout_results:
-            page_idx = page_data.get("page_idx", 0)
-            if page_idx >= len(doc): break
-            
-            page = doc[page_idx]
-            boxes = page_data.get("boxes", [])
-            
-            box_contents = self.map_words_to_boxes(page, boxes)
-            
-            page_boxes = []
-            page_empty_boxes = []
+            if page_data.get("page_idx", 0) >= len(doc): break
+
+            has_text = page_data.get("page_idx", 0) not in no_text_pages
+            page_result, page_empty = self.extract_page(page_data, doc, has_text)
+            final_output.append(page_result)
+            if page_empty is not None:
+                empty_output.append(page_empty)
+
+        self.extracted_text = final_output
+        self.empty_regions = empty_output
+        return final_output, empty_output
+
+    # One page of text boxes in, (text results, empty boxes or None) out, used directly when streaming pages
+    def extract_page(self, page_data, doc, has_text=True):
+        page_idx = page_data.get("page_idx", 0)
+        input_path = page_data.get("input_path", doc.input_path)
+        boxes = page_data.get("boxes", [])
+        
+        # Scanned pages skip the word extraction, it would find nothing
+        with profiler.stage("text.words", pages=1):
+            words = doc.words(page_idx) if has_text else []
+        with profiler.stage("text.assign_words", pages=1, boxes=len(boxes)):
+            box_contents = self.assign_words(words, boxes)
+        
+        page_boxes = []
+        page_empty_boxes = []
+        with profiler.stage("text.post_process", pages=1, boxes=len(boxes)):
             for idx, box in enumerate(boxes):
                 text_list = box_contents[idx]
                 region = box.copy()
                 
                 if text_list:
                     raw_text = " ".join(text_list)
-                    region["text"] = self.post_processor.process(raw_text)
+                    first = self.regions.seen(box, page_idx, raw_text) if self.dedupe else None
+                    if first is not None:
+                        region["text"] = ""
+                        region["duplicate_of"] = list(first)
+                    else:
+                        if raw_text not in self.processed:
+                            self.processed[raw_text] = self.post_processor.process(raw_text)
+                        region["text"] = self.processed[raw_text]
                 else:
                     region["text"] = ""
                     page_empty_boxes.append(region.copy())
                 
                 page_boxes.append(region)
-            
-            final_output.append({
-                "input_path": self.input_path,
+        
+        page_result = {
+            "input_path": input_path,
+            "page_idx": page_idx,
+            "image_size": page_data.get("image_size"),
+            "pdf_size": page_data.get("pdf_size"),
+            "boxes": page_boxes
+        }
+        
+        page_empty = None
+        if page_empty_boxes:
+            page_empty = {
+                "input_path": input_path,
                 "page_idx": page_idx,
                 "image_size": page_data.get("image_size"),
                 "pdf_size": page_data.get("pdf_size"),
-                "boxes": page_boxes
-            })
-            
-            if page_empty_boxes:
-                empty_output.append({
-                    "input_path": self.input_path,
-                    "page_idx": page_idx,
-                    "image_size": page_data.get("image_size"),
-                    "pdf_size": page_data.get("pdf_size"),
-                    "boxes": page_empty_boxes
-                })
-
-        doc.close()
-        self.extracted_text = final_output
-        self.empty_regions = empty_output
-        return final_output, empty_output
+                "boxes": page_empty_boxes
+            }
+
+        return page_result, page_empty
 
     def save_results(self, output_path):
         if not self.extracted_text:
-            return
+            return []
 
         os.makedirs(output_path, exist_ok=True)
             
@@ -189,81 +540,287 @@ class TextExtract:
         with open(empty_path, "w", encoding="utf-8") as f:
             json.dump(self.empty_regions, f, ensure_ascii=False, indent=4)
 
+        return [json_path, empty_path]
+
 class TableExtract:
-    def __init__(self):
+    ENGINES = ("auto", "model")
+
+    # engine="auto" rebuilds born-digital tables from ruling lines and words (see NativeTables) and only crops the
+    # tables it cannot trust for the structure model, engine="model" crops every table
+    def __init__(self, crop_workers=0, dpi_policy=None, engine="auto", native=None, crop_inflight_bytes=SectionCrop.MAX_INFLIGHT_BYTES):
+        if engine not in self.ENGINES:
+            raise ValueError(f"Unknown table engine {engine!r}")
         self.results = None
+        self.tables = []
         self.input_path = None
-
-    def extract(self, table_coordinates):
+        self.crop_workers = crop_workers
+        self.crop_inflight_bytes = crop_inflight_bytes
+        self.dpi_policy = dpi_policy
+        self.engine = engine
+        self.native = native or NativeTables()
+
+    # One record per table, "method" is "native" (with rows, cells and markdown) or "model" (cropped)
+    def extract(self, table_coordinates, document=None):
+        self.results = None
+        self.tables = []
         if not table_coordinates:
             return []
         self.input_path = table_coordinates[0]["input_path"]
-        cropped = SectionCrop.crop(table_coordinates)
+
+        with open_document(document or self.input_path) as doc:
+            remaining = []
+            for page_data in table_coordinates:
+                if page_data["page_idx"] >= len(doc):
+                    continue
+
+                boxes = []
+                for box in page_data["boxes"]:
+                    table, checks = None, None
+                    if self.engine == "auto":
+                        with profiler.stage("table.native", boxes=1):
+                            table, checks = self.native.reconstruct(doc, page_data["page_idx"], box)
+
+                    record = {
+                        "page_idx": page_data["page_idx"],
+                        "order": box["order"],
+                        "label": box["label"],
+                        "pdf_bbox": box["pdf_bbox"],
+                        "method": "native" if table is not None else "model",
+                        "confidence": checks
+                    }
+                    if table is not None:
+                        record.update(rows=table["rows"], cells=table["cells"], markdown=table["markdown"])
+                    else:
+                        boxes.append(box)
+                    self.tables.append(record)
+
+                if boxes:
+                    remaining.append({**page_data, "boxes": boxes})
+
+            # Arrays for the structure model, save_results builds the PNGs lazily
+            cropped = SectionCrop.crop(remaining, doc, self.crop_workers, self.dpi_policy, output="array", max_inflight_bytes=self.crop_inflight_bytes)
         # TODO: feed cropped images to TableFormer model
         self.results = cropped
-        return cropped
+        return self.tables
 
-    def save_results(self, output_path):
-        if not self.results:
-            return
+    # The crops are debug images, only the JSON is returned as the stage's output
+    def save_results(self, output_path, debug=None):
+        if not self.tables:
+            return []
+        os.makedirs(output_path, exist_ok=True)
         pdf_name = os.path.splitext(os.path.basename(self.input_path))[0]
-        SectionCrop.save_images(self.results, output_path, pdf_name)
+
+        json_path = os.path.join(output_path, f"{pdf_name}_table_results.json")
+        with open(json_path, "w", encoding="utf-8") as f:
+            json.dump(self.tables, f, ensure_ascii=False, indent=4)
+
+        SectionCrop.save_images(self.results or [], output_path, pdf_name, debug)
+        return [json_path]
 
 class VLMExtract:
-    def __init__(self):
+    # Grounded blocks in the model's answer: <|ref|>label<|/ref|><|det|>[[x0, y0, x1, y1]]<|/det|> then the block's markdown,
+    # coordinates are on a 0-999 grid over the whole input image
+    BLOCK_RE = re.compile(r"<\|ref\|>(.*?)<\|/ref\|><\|det\|>(.*?)<\|/det\|>(.*?)(?=<\|ref\|>|\Z)", re.S)
+    GRID = 999
+
+    # DeepSeek-OCR-2 works on a 1024 base view (768 tiles), anything above that is downscaled anyway.
+    # Small empty regions are packed onto shared canvas_size canvases (at most max_regions each) so one model call
+    # reads many of them, the grounding boxes in the answer tell which region each block came from.
+    # dedupe: regions that look the same (label, position and a low resolution render) as one on an earlier page
+    # are read once, the later ones get "duplicate_of": [page_idx, order]
+    FINGERPRINT_DPI = 36
+
+    def __init__(self, model='deepseek-ai/DeepSeek-OCR-2', crop_workers=0, dpi_policy=None, canvas_size=1024, gap=24, max_regions=16, dedupe=False, crop_inflight_bytes=SectionCrop.MAX_INFLIGHT_BYTES):
         self.input_path = None
         self.cropped_images = None
+        self.canvases = None
+        self.results = None
+        self.crop_workers = crop_workers
+        self.crop_inflight_bytes = crop_inflight_bytes
+        self.dpi_policy = dpi_policy or DPIPolicy(target_size=1024)
+        self.model_name = model
+        self.canvas_size = canvas_size
+        self.gap = gap
+        self.max_regions = max_regions
+        self.dedupe = dedupe
 
-        model_name = 'deepseek-ai/DeepSeek-OCR-2' 
+        self.prompt = "<image>\n<|grounding|>Convert the document to markdown. "
 
-        self.tokenizer = AutoTokenizer.from_pretrained(model_name, trust_remote_code=True)
-        self.model = AutoModel.from_pretrained(model_name, trust_remote_code=True, use_safetensors=True)
+    # Tokenizer, model, device and dtype are loaded together on first use (torch and transformers are imported then)
+    @property
+    def tokenizer(self):
+        return registry.get("vlm", self.model_name)["tokenizer"]
 
-        self.dtype = torch.float16
-        if torch.cuda.is_available():
-            self.device = "cuda"
-            if torch.cuda.is_bf16_supported():
-                self.dtype = torch.bfloat16
-        else:
-            self.device = "cpu"
+    @property
+    def model(self):
+        return registry.get("vlm", self.model_name)["model"]
 
-        self.model = self.model.eval().to(self.device).to(self.dtype)
+    @property
+    def device(self):
+        return registry.get("vlm", self.model_name)["device"]
 
-        self.prompt = "<image>\n<|grounding|>Convert the document to markdown. "
-        # self.image_file = 'your_image.jpg'
-        # self.output_path = 'your/output/dir'        
+    @property
+    def dtype(self):
+        return registry.get("vlm", self.model_name)["dtype"]
+
+    # Re-OCR of the text regions PyMuPDF found no text for, returns empty_coordinates with the markdown as "text"
+    def partial_extract(self, empty_coordinates, document=None):
+        self.results = None
+        self.canvases = None
+        self.cropped_images = None
+        if not empty_coordinates:
+            return []
+
+        with open_document(document or empty_coordinates[0]["input_path"]) as doc:
+            duplicates = {}
+            unique_coordinates = empty_coordinates
+            if self.dedupe:
+                unique_coordinates, duplicates = self.unique_regions(empty_coordinates, doc)
+            self.cropped_images = SectionCrop.crop(
+                unique_coordinates, doc, self.crop_workers, self.dpi_policy, output="array", max_inflight_bytes=self.crop_inflight_bytes
+            )
+        if not self.cropped_images:
+            return []
+        self.input_path = empty_coordinates[0]["input_path"]
+
+        self.canvases = self.pack(self.cropped_images)
+        texts = {}
+        for canvas in self.canvases:
+            texts.update(self.read_canvas(canvas))
 
+        results = []
+        for page_data in empty_coordinates:
+            boxes = []
+            for box in page_data["boxes"]:
+                region = box.copy()
+                key = (page_data["page_idx"], box["order"])
+                region["text"] = texts.get(key, "")
+                if key in duplicates:
+                    region["duplicate_of"] = list(duplicates[key])
+                boxes.append(region)
+            results.append({**page_data, "boxes": boxes})
+
+        self.results = results
+        return results
+
+    # (coordinates with only the first occurrence of every region, {(page_idx, order): (page_idx, order) of the first})
+    def unique_regions(self, empty_coordinates, doc):
+        regions = RegionIndex()
+        duplicates = {}
+        unique_coordinates = []
+        for page_data in empty_coordinates:
+            page_idx = page_data["page_idx"]
+            boxes = []
+            for box in page_data["boxes"]:
+                pixels = doc.render_clip(page_idx, box["pdf_bbox"], self.FINGERPRINT_DPI).samples
+                first = regions.seen(box, page_idx, pixels)
+                if first is None:
+                    boxes.append(box)
+                else:
+                    duplicates[(page_idx, box["order"])] = first
+            if boxes:
+                unique_coordinates.append({**page_data, "boxes": boxes})
+        return unique_coordinates, duplicates
+
+    # Crops copied onto white canvases, each canvas keeps where every region went (x0, y0, x1, y1 in canvas pixels)
+    def pack(self, cropped_images):
+        sizes = [(c["array"].shape[1], c["array"].shape[0]) for c in cropped_images]
+
+        canvases = []
+        for placements, width, height in pack_shelves(sizes, self.canvas_size, self.canvas_size, self.gap, self.max_regions):
+            array = np.full((height, width, 3), 255, dtype=np.uint8)
+            slots = []
+            for i, x, y in placements:
+                crop_data = cropped_images[i]
+                h, w = crop_data["array"].shape[:2]
+                array[y:y + h, x:x + w] = crop_data["array"]
+                slots.append({"page_idx": crop_data["page_idx"], "order": crop_data["order"], "rect": [x, y, x + w, y + h]})
+            canvases.append({"array": array, "slots": slots})
+        return canvases
+
+    # {(page_idx, order): markdown} for every region on the canvas
+    def read_canvas(self, canvas):
+        slots = canvas["slots"]
+        answer = self.infer(canvas["array"])
+        if len(slots) == 1:
+            return {(slots[0]["page_idx"], slots[0]["order"]): self.strip_grounding(answer)}
+
+        blocks = self.parse_blocks(answer, canvas["array"].shape[1], canvas["array"].shape[0])
+        if not blocks:
+            # Nothing to map the answer back with, read the regions one at a time instead
+            return {
+                (slot["page_idx"], slot["order"]): self.strip_grounding(self.infer(self.slot_array(canvas, slot)))
+                for slot in slots
+            }
+
+        # Every block goes to the region most of it lies in, blocks keep the model's reading order
+        _, ioa = intersection_over_a([rect for rect, _ in blocks], [slot["rect"] for slot in slots])
+        texts = {(slot["page_idx"], slot["order"]): [] for slot in slots}
+        for (_, text), scores in zip(blocks, ioa):
+            if np.isfinite(scores.max()) and text:
+                slot = slots[int(scores.argmax())]
+                texts[(slot["page_idx"], slot["order"])].append(text)
+
+        return {key: "\n\n".join(parts) for key, parts in texts.items()}
 
-    def partial_extract(self, empty_coordinates):
-        self.cropped_images = SectionCrop.crop(empty_coordinates)
-        if self.cropped_images:
-            self.input_path = empty_coordinates[0]["input_path"]
-        # TODO: run VLM inference on self.cropped_images
+    @staticmethod
+    def slot_array(canvas, slot):
+        x0, y0, x1, y1 = slot["rect"]
+        return canvas["array"][y0:y1, x0:x1]
+
+    # [(rect in canvas pixels, markdown)], empty when the answer has no grounding boxes
+    def parse_blocks(self, answer, width, height):
+        blocks = []
+        for match in self.BLOCK_RE.finditer(answer):
+            try:
+                rects = json.loads(match.group(2))
+            except json.JSONDecodeError:
+                continue
+            rects = [r for r in rects if len(r) == 4]
+            if not rects:
+                continue
+            x0, y0 = min(r[0] for r in rects), min(r[1] for r in rects)
+            x1, y1 = max(r[2] for r in rects), max(r[3] for r in rects)
+            rect = [x0 * width / self.GRID, y0 * height / self.GRID, x1 * width / self.GRID, y1 * height / self.GRID]
+            blocks.append((rect, match.group(3).strip()))
+        return blocks
+
+    def strip_grounding(self, answer):
+        blocks = [text for _, _, text in self.BLOCK_RE.findall(answer)]
+        text = "\n\n".join(block.strip() for block in blocks if block.strip()) if blocks else answer
+        return text.strip()
+
+    # One model call on an in-memory image, the PNG is only encoded into a buffer (the model opens it with PIL)
+    def infer(self, array):
+        buffer = io.BytesIO()
+        Image.fromarray(np.ascontiguousarray(array)).save(buffer, format="PNG")
+        buffer.seek(0)
+
+        with profiler.stage("vlm.infer", boxes=1, pixels=array.shape[0] * array.shape[1]):
+            answer = self.model.infer(
+                self.tokenizer, prompt=self.prompt, image_file=buffer, output_path=tempfile.gettempdir(),
+                base_size=1024, image_size=768, crop_mode=True, save_results=False, test_compress=False, eval_mode=True
+            )
+        return answer or ""
 
     def full_extract(self):
         pass
 
-
-    def save_results(self, output_path):
+    # The crops are debug images, only the JSON is returned as the stage's output
+    def save_results(self, output_path, debug=None):
         if not self.cropped_images:
-            return
+            return []
         
         os.makedirs(output_path, exist_ok=True)
         
         pdf_name = os.path.splitext(os.path.basename(self.input_path))[0]
-        
-        for crop_data in self.cropped_images:
-            page_idx = crop_data["page_idx"]
-            order = crop_data["order"]
-            label = crop_data["label"]
-            image = crop_data["image"]
-            
-            filename = f"{pdf_name}_p{page_idx}_o{order}_{label}.png"
-            image_path = os.path.join(output_path, filename)
-            image.save(image_path)
+        SectionCrop.save_images(self.cropped_images, output_path, pdf_name, debug)
 
-    # VLM
-    def extract(self):
-        pass
+        written = []
+        if self.results is not None:
+            json_path = os.path.join(output_path, f"{pdf_name}_vlm_results.json")
+            with open(json_path, "w", encoding="utf-8") as f:
+                json.dump(self.results, f, ensure_ascii=False, indent=4)
+            written.append(json_path)
 
-        res = self.model.infer(self.tokenizer, prompt=self.prompt, image_file=self.image_file, output_path = self.output_path, base_size = 1024, image_size = 768, crop_mode = True, save_results = True, test_compress = True)
\ No newline at end of file
+        return written
@@ -0,0 +1,150 @@
+import numpy as np
+from Geometry import intersection_over_a, areas
+
+# Rebuilds born-digital tables from the PDF itself, ruling lines first and word gaps after that, no model involved.
+# A rebuilt table is only trusted when the words of the region land in its cells (coverage), hardly any word is
+# cut by a cell border (split), few rows come out empty and it lines up with the layout box (area, their IoU).
+# Anything less is left to the crop and the structure model.
+class NativeTables:
+    STRATEGIES = ("lines", "text")
+
+    # Ruled tables are found once per page and matched to the layout boxes, word gap tables only exist relative to
+    # a region so they are searched in the box, widened by clip_margin points since layout boxes often cut the border.
+    # Both searches are the expensive part, the ruled one is skipped when the box has no horizontal and vertical
+    # drawings to form cells from, the word gap one when the ruled search already found the box's table.
+    def __init__(self, strategies=STRATEGIES, min_coverage=0.95, max_split=0.02, max_empty_rows=0.2, min_area=0.5, clip_margin=4):
+        self.strategies = tuple(strategies)
+        self.min_coverage = min_coverage
+        self.max_split = max_split
+        self.max_empty_rows = max_empty_rows
+        self.min_area = min_area
+        self.clip_margin = clip_margin
+
+    # Everything that changes which tables are trusted
+    def settings(self):
+        return [list(self.strategies), self.min_coverage, self.max_split, self.max_empty_rows, self.min_area, self.clip_margin]
+
+    # (table, checks) for one layout box, table is None when no strategy gives a confident one.
+    # checks are the confidence measures of the trusted table, or of the best attempt when none was.
+    def reconstruct(self, doc, page_idx, box):
+        bbox = box["pdf_bbox"]
+        words = self.region_words(doc.words(page_idx), bbox)
+
+        x0, y0, x1, y1 = bbox
+        m = self.clip_margin
+        clip = [x0 - m, y0 - m, x1 + m, y1 + m]
+
+        best = None
+        matched = False
+        for strategy in self.strategies:
+            if strategy == "lines":
+                if not self.ruled(doc.drawings(page_idx), clip):
+                    continue
+                tables = doc.find_tables(page_idx, None, strategy)
+            else:
+                if matched:
+                    continue
+                tables = doc.find_tables(page_idx, clip, strategy)
+            if not tables:
+                continue
+
+            # The region's own table is the one that overlaps it the most
+            table = max(tables, key=lambda t: self.iou(t["bbox"], bbox))
+            rows, checks = self.fill(table, words, bbox)
+            checks = {"strategy": strategy, **checks}
+            if checks["confident"]:
+                return {**table, "rows": rows, "markdown": self.markdown(rows)}, checks
+            matched = matched or checks["area"] >= self.min_area
+            if best is None or checks["coverage"] > best["coverage"]:
+                best = checks
+
+        return None, best or {"strategy": None, "confident": False}
+
+    # Whether the drawings touching bbox run both across and down, cells need both
+    @staticmethod
+    def ruled(drawings, bbox):
+        x0, y0, x1, y1 = bbox
+        across = down = False
+        for dx0, dy0, dx1, dy1 in drawings:
+            if dx0 <= x1 and dx1 >= x0 and dy0 <= y1 and dy1 >= y0:
+                across = across or dx1 - dx0 > 1
+                down = down or dy1 - dy0 > 1
+                if across and down:
+                    return True
+        return False
+
+    # Words (PyMuPDF word tuples) whose center lies in bbox
+    @staticmethod
+    def region_words(page_words, bbox):
+        x0, y0, x1, y1 = bbox
+        return [w for w in page_words if x0 <= (w[0] + w[2]) / 2 <= x1 and y0 <= (w[1] + w[3]) / 2 <= y1]
+
+    @staticmethod
+    def iou(a, b):
+        _, ioa = intersection_over_a(a, b)
+        if ioa[0, 0] < 0:
+            return 0.0
+        intersection = ioa[0, 0] * areas(a)[0]
+        return float(intersection / (areas(a)[0] + areas(b)[0] - intersection))
+
+    # The cell texts (rows of strings, None where a merged cell continues) from the words each cell holds most of,
+    # and the confidence checks of the table
+    def fill(self, table, words, bbox):
+        positions = [(r, c) for r, row in enumerate(table["cells"]) for c, cell in enumerate(row) if cell is not None]
+        cells = [table["cells"][r][c] for r, c in positions]
+        row_count = len(table["cells"])
+        col_count = max((len(row) for row in table["cells"]), default=0)
+
+        cell_words = [[[] if cell is not None else None for cell in row] for row in table["cells"]]
+        # Without words (a scanned table) there is nothing to check the cells against
+        if not cells or not words:
+            coverage, split = 0.0, 0.0
+        else:
+            _, ioa = intersection_over_a([w[:4] for w in words], cells)
+            best = ioa.max(axis=1)
+            coverage = float(np.mean(best >= 0.5))
+            split = float(np.mean((ioa >= 0.2).sum(axis=1) >= 2))
+            for word, k, share in zip(words, ioa.argmax(axis=1), best):
+                if share >= 0.5:
+                    r, c = positions[k]
+                    cell_words[r][c].append(word)
+
+        rows = [[self.cell_text(w) if w is not None else None for w in row] for row in cell_words]
+
+        empty_rows = sum(1 for row in rows if not any(row))
+        empty_rows = empty_rows / row_count if row_count else 1.0
+        area = self.iou(table["bbox"], bbox)
+
+        confident = (
+            row_count >= 2 and col_count >= 2
+            and coverage >= self.min_coverage
+            and split <= self.max_split
+            and empty_rows <= self.max_empty_rows
+            and area >= self.min_area
+        )
+        return rows, {
+            "rows": row_count,
+            "cols": col_count,
+            "coverage": round(coverage, 4),
+            "split": round(split, 4),
+            "empty_rows": round(empty_rows, 4),
+            "area": round(area, 4),
+            "confident": confident
+        }
+
+    # Words in reading order (block, line, word number), one text line per line of the PDF
+    @staticmethod
+    def cell_text(words):
+        lines = {}
+        for w in sorted(words, key=lambda w: (w[5], w[6], w[7])):
+            lines.setdefault((w[5], w[6]), []).append(w[4])
+        return "\n".join(" ".join(line) for line in lines.values())
+
+    # GitHub markdown with the first row as the header, cells a merged cell continues into are left empty
+    @staticmethod
+    def markdown(rows):
+        def line(row):
+            return "|" + "|".join((text or "").replace("|", "\\|").replace("\n", "<br>") for text in row) + "|"
+
+        header, *body = rows
+        return "\n".join([line(header), "|" + "---|" * len(header)] + [line(row) for row in body]) + "\n"
@@ -1,41 +1,88 @@
-from Analyzer import Analyze
+import argparse
+from Manifest import STAGES
 from LayoutDetector import LayoutDetect
-from SectionExtractor import TextExtract, TableExtract, MathExtract, VLMExtract
+from Scheduler import DocumentScheduler, collect_inputs, duplicate_names
 
 def main():
-    input_path = "pdfs/test2.pdf"
+    parser = argparse.ArgumentParser(description="Extract text, tables and math from PDFs.")
+    parser.add_argument("inputs", nargs="*", default=["pdfs/test2.pdf"], help="PDF files, directories, glob patterns or manifest files (one path per line)")
+    parser.add_argument("-w", "--workers", type=int, default=1, help="Number of worker processes, each loads its own models once")
+    parser.add_argument("-o", "--output", default="output", help="Directory for the debugging output")
+    parser.add_argument("--math", action="store_true", help="Run formula recognition on math regions")
+    parser.add_argument("--vlm", action="store_true", help="Read empty text regions with the VLM, every region of scanned pages included")
+    parser.add_argument("--stream", action="store_true", help="Extract text page by page while layout detection is still running")
+    parser.add_argument("--layout-cache", default=None, help="Directory for the on-disk layout detection cache")
+    parser.add_argument("--layout-cache-mb", type=int, default=1024, help="Size limit of the layout cache in MB")
+    parser.add_argument("--crop-workers", type=int, default=0, help="Processes used to render table, math and VLM crops, 0 renders in the main process")
+    parser.add_argument("--crop-inflight-mb", type=int, default=512, help="Rendered crops the crop workers may have waiting to be taken, in MB")
+    parser.add_argument("--math-batch-size", type=int, default=16, help="Formula crops per recognition batch")
+    parser.add_argument("--model-memory-mb", type=int, default=None, help="Unload the least recently used models once a worker uses more memory than this")
+    parser.add_argument("--resume", action="store_true", help="Skip the stages each document's manifest marks as finished with the same input")
+    parser.add_argument("--rerun", action="append", default=[], choices=STAGES, help="Run this stage again for every document and resume the others, can be repeated")
+    parser.add_argument("--profile-stage", action="append", default=[], help="Also run this stage (e.g. text or text.post_process) under cProfile, writes <name>_<stage>.prof, can be repeated")
+    parser.add_argument("--dedupe", action="store_true", help="Read regions repeated across pages (headers, footers, stamps) once, later ones reference the first")
+    parser.add_argument("--shard-pages", type=int, default=None, help="Split documents with more pages than this into page ranges that run on separate workers and are merged after, not with --dedupe or --resume")
+    parser.add_argument("--pages", action="store_true", help="Also write the compact <name>_pages.ndjson.gz output, one line per page")
+    parser.add_argument("--raster-cache-mb", type=int, default=256, help="Memory for the layout page images math and VLM crops are cut from, past it they spill to a temp file, 0 renders every crop (as sharded documents always do)")
+    parser.add_argument("--table-engine", default="auto", choices=["auto", "model"], help="auto rebuilds born-digital tables from ruling lines and words and crops only the rest for the model, model crops every table")
+    parser.add_argument("--debug-output", default="full", choices=["off", "sampled", "full"], help="Which layout page images and table/VLM crops to write (in a background thread), the JSON results are always written")
+    parser.add_argument("--debug-every-pages", type=int, default=10, help="With --debug-output sampled, write the images of every Nth page")
+    parser.add_argument("--debug-every-documents", type=int, default=1, help="With --debug-output sampled, write images for about one in N documents (the same ones on every run)")
+    parser.add_argument("--debug-empty-pages", action="store_true", help="With --debug-output sampled, write images only for pages with empty text regions")
+    parser.add_argument("--route", action="append", default=[], metavar="LABEL=ROUTE", help="Send a layout label to text, table, math, vlm or none (dropped), can be repeated")
+    parser.add_argument("--min-score", action="append", default=[], metavar="NAME=SCORE", help="Drop boxes of a label or route under this score, can be repeated")
+    args = parser.parse_args()
 
-    analyzer = Analyze()
+    try:
+        routes = {label: (None if route == "none" else route) for label, route in (item.split("=", 1) for item in args.route)}
+        min_scores = {name: float(score) for name, score in (item.split("=", 1) for item in args.min_score)}
+    except ValueError:
+        parser.error("--route and --min-score take NAME=VALUE")
 
-    if analyzer.has_text_layer(input_path):
-        detector = LayoutDetect()
-        layout_coordinates = detector.detect(input_path)
-        text_coordinates, table_coordinates, math_coordinates = detector.filter(layout_coordinates)
-        detector.save_results("output") # For visual debugging
+    # Checked here, a worker failing on them would only show up as a broken process pool
+    unknown = [f"{label}={route}" for label, route in routes.items() if route is not None and route not in LayoutDetect.ROUTES]
+    if unknown:
+        parser.error(f"Unknown --route {', '.join(unknown)}, routes are {', '.join(LayoutDetect.ROUTES)} and none")
+    names = LayoutDetect.TEXT_LABELS | LayoutDetect.TABLE_LABELS | LayoutDetect.MATH_LABELS | LayoutDetect.UNWANTED_LABELS | set(routes) | set(LayoutDetect.ROUTES)
+    unknown = sorted(set(min_scores) - names)
+    if unknown:
+        parser.error(f"Unknown --min-score {', '.join(unknown)}, expected a layout label or one of {', '.join(LayoutDetect.ROUTES)}")
 
-        # <section>_coordinates are never truly empty so create functions that check them
-        if text_coordinates is not None:
-            text_extractor = TextExtract()
-            text_results, text_results_empty = text_extractor.extract(text_coordinates)
-            text_extractor.save_results("output") # For visual debugging
-            # if text is empty then
-            # vlm_extractor = VLMExtract()
-            # vlm_extractor.coordinate_extraction(text_results_empty)
-            # vlm_extractor.save_results("output") # For visual debugging
-    
-        if table_coordinates is not None:
-            table_extractor = TableExtract()
-            table_extractor.extract(table_coordinates)
-            table_extractor.save_results("output") # For visual debugging
+    input_paths = collect_inputs(args.inputs)
+    if not input_paths:
+        parser.error("No PDFs found.")
+    duplicates = duplicate_names(input_paths)
+    if duplicates:
+        parser.error("Outputs are named after the PDF's file name, rename or run these separately: " + "; ".join(", ".join(paths) for paths in duplicates.values()))
 
-        # if math_coordinates is not None:
-        #     math_extractor = MathExtract()
-        #     math_extractor.extract(input_path, math_coordinates)
-        #     math_extractor.save_results("output") # For visual debugging
-
-    else:
-        print("No text found in the PDF.") 
-        # VLM
+    scheduler = DocumentScheduler(
+        workers=args.workers,
+        shard_pages=args.shard_pages,
+        output_path=args.output,
+        math=args.math,
+        vlm=args.vlm,
+        stream=args.stream,
+        layout_cache=args.layout_cache,
+        layout_cache_mb=args.layout_cache_mb,
+        crop_workers=args.crop_workers,
+        crop_inflight_mb=args.crop_inflight_mb,
+        math_batch_size=args.math_batch_size,
+        pages_output=args.pages,
+        model_memory_mb=args.model_memory_mb,
+        resume=args.resume,
+        rerun=args.rerun,
+        profile_stages=args.profile_stage,
+        dedupe=args.dedupe,
+        routes=routes,
+        min_scores=min_scores,
+        raster_cache_mb=args.raster_cache_mb,
+        table_engine=args.table_engine,
+        debug_output=args.debug_output,
+        debug_every_pages=args.debug_every_pages,
+        debug_every_documents=args.debug_every_documents,
+        debug_empty_pages=args.debug_empty_pages
+    )
+    scheduler.run(input_paths)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file